@@ -0,0 +1,22 @@
+# app/_canon.py
+"""
+normalize SKU / agent slug ก่อน lookup ตาราง tier (ใช้โดย agent_tiers.classify_agent_tier เท่านั้น)
+หมายเหตุ: agents.get_agent_slug_from_sku ไม่ได้ใช้ตัวนี้ — กติกาของมันแคบกว่า (ตัด platform suffix ได้ตัวเดียว,
+ไม่ตัด module-0- / _ai_agent) การใช้ร่วมกันจะเปลี่ยนว่า SKU ไหน resolve เป็น agent ได้
+- ทำให้เป็นตัวพิมพ์เล็ก + ตัดช่องว่าง
+- ตัด prefix 'module-0-'
+- ตัด suffix '_gemini' / '_ms'
+- ตัด suffix พิเศษ '_ai_agent' ที่มาจาก slug เดิม (เช่น SINGLE_CF_AI_AGENT)
+"""
+from functools import lru_cache
+
+
+@lru_cache(maxsize=1024)
+def canon_sku(s: str) -> str:
+    return (
+        (s or "").strip().lower()
+        .removeprefix("module-0-")
+        .removesuffix("_gemini")
+        .removesuffix("_ms")
+        .removesuffix("_ai_agent")
+    )
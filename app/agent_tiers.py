@@ -2,14 +2,17 @@
 """
 จำแนก agent ออกเป็น 3 ระดับ: STANDARD / PLUS / PREMIUM
 - รองรับทั้ง slug canonical (budget_standard) และ alias SKU (buds, capexs, revp ...)
-- normalize ค่าที่เข้ามาให้เป็นรูปแบบเทียบได้ (ตัด prefix/suffix module-0-*, *_gemini, *_ms, *_ai_agent)
+- normalize ค่าที่เข้ามาด้วย app._canon.canon_sku (ตัด prefix/suffix module-0-*, *_gemini, *_ms, *_ai_agent)
 """
+from functools import lru_cache
 from typing import Literal
 
+from app._canon import canon_sku
+
 TierCode = Literal["STANDARD", "PLUS", "PREMIUM"]
 
 # --- ชุดมาตรฐานตาม family (รวม alias SKU สำคัญเพื่อให้ครอบคลุม) ---
-STANDARD_SET = {
+STANDARD_SET = frozenset({
     # CF family
     "single_cf", "project_cf", "enterprise_cf",
     "scf", "pcf", "entcf",  # alias ยอดนิยม
@@ -33,9 +36,9 @@ STANDARD_SET = {
     "forecast_standard", "fors",
     # Decision
     "decision_standard", "decs",
-}
+})
 
-PLUS_SET = {
+PLUS_SET = frozenset({
     # Revenue (intermediate)
     "revenue_intermediate", "revp",
     # Budget
@@ -56,9 +59,9 @@ PLUS_SET = {
     "forecast_plus", "forp",
     # Decision
     "decision_plus", "decp",
-}
+})
 
-PREMIUM_SET = {
+PREMIUM_SET = frozenset({
     # Revenue (advance/premium)
     "revenue_advance", "revpr",
     # Budget
@@ -79,30 +82,16 @@ PREMIUM_SET = {
     "forecast_premium", "forpr",
     # Decision
     "decision_premium", "decpr",
-}
+})
 
-def _canon(s: str) -> str:
-    """
-    - ทำให้เป็นตัวพิมพ์เล็ก
-    - ตัด prefix 'module-0-'
-    - ตัด suffix '_gemini' / '_ms'
-    - ตัด suffix พิเศษ '_ai_agent' ที่มาจาก slug เดิม (เช่น SINGLE_CF_AI_AGENT)
-    """
-    s = (s or "").strip().lower()
-    if s.startswith("module-0-"):
-        s = s[9:]
-    if s.endswith("_gemini"):
-        s = s[:-7]
-    if s.endswith("_ms"):
-        s = s[:-3]
-    if s.endswith("_ai_agent"):
-        s = s[:-9]
-    return s
+# --- รวมเป็น dict เดียว (alias -> tier) สร้างครั้งเดียวตอน import ---
+# ลำดับ union: ตัวหลังทับตัวหน้า → PREMIUM ชนะ PLUS ชนะ STANDARD (เหมือนลำดับ if เดิม)
+ALIAS_TO_TIER: dict[str, TierCode] = (
+    {k: "STANDARD" for k in STANDARD_SET}
+    | {k: "PLUS" for k in PLUS_SET}
+    | {k: "PREMIUM" for k in PREMIUM_SET}
+)
 
+@lru_cache(maxsize=512)
 def classify_agent_tier(agent_slug_or_sku: str) -> TierCode:
-    s = _canon(agent_slug_or_sku)
-    if s in PREMIUM_SET:
-        return "PREMIUM"
-    if s in PLUS_SET:
-        return "PLUS"
-    return "STANDARD"
+    return ALIAS_TO_TIER.get(canon_sku(agent_slug_or_sku), "STANDARD")
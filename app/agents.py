@@ -1,4 +1,5 @@
 # agents.py – extended mapping with GPT, Gemini, Copilot (incl. enterprise SKUs)
+from functools import lru_cache
 
 AGENT_SKU_TO_AGENT = {
     # ===== Budget =====
@@ -133,17 +134,21 @@ AGENT_SKU_TO_AGENT = {
 }
 
 
-# --- Extend dynamically with Gemini + Copilot suffixes ---
-_extended = {}
-for sku, agent in list(AGENT_SKU_TO_AGENT.items()):
-    if not sku.startswith("en_"):  # don't suffix enterprise SKUs
-        _extended[f"{sku}_gemini"] = agent
-        _extended[f"{sku}_ms"] = agent
-AGENT_SKU_TO_AGENT.update(_extended)
+# Gemini/Copilot variants (<sku>_gemini, <sku>_ms) are not stored as separate keys;
+# get_agent_slug_from_sku strips at most one suffix before lookup. Narrower than app._canon.canon_sku on
+# purpose (no module-0- / _ai_agent handling): widening it changes which SKUs resolve to an agent.
 
 
+@lru_cache(maxsize=512)
 def get_agent_slug_from_sku(sku: str):
     if not sku:
         return None
     key = sku.strip().lower()
-    return AGENT_SKU_TO_AGENT.get(key)
+    agent = AGENT_SKU_TO_AGENT.get(key)
+    if agent is None and not key.startswith("en_"):  # enterprise SKUs never carry a platform suffix
+        # ตัด platform suffix ได้ตัวเดียว (เท่ากับตาราง <sku>_gemini / <sku>_ms เดิม; x_ms_gemini → None)
+        for suffix in ("_gemini", "_ms"):
+            if key.endswith(suffix):
+                agent = AGENT_SKU_TO_AGENT.get(key.removesuffix(suffix))
+                break
+    return agent
@@ -1,60 +1,53 @@
 # app/api_run.py
 from fastapi import APIRouter, Header, HTTPException, Body, Request
-from pydantic import BaseModel, Field, constr, validator
-from typing import Optional, Literal, List, Dict, Any
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field, ConfigDict, StringConstraints
+from typing import Optional, Literal, List, Dict, Any, Annotated, Tuple
 import httpx, os
 
-# ===== Models =====
+# ===== Models (pydantic v2) =====
 Role = Literal["system", "user", "assistant"]
+NonEmptyStr = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
 
 class ChatMessage(BaseModel):
     role: Role
-    content: constr(strip_whitespace=True, min_length=1)
+    content: NonEmptyStr
 
 class InputPayload(BaseModel):
     messages: Optional[List[ChatMessage]] = Field(default=None)
     # รับ key อื่น ๆ เพิ่มได้ (additionalProperties)
-    __root__: Optional[Dict[str, Any]] = None
+    model_config = ConfigDict(extra="allow")
 
 class RunRequest(BaseModel):
-    agent_slug: constr(strip_whitespace=True, min_length=1)
+    agent_slug: NonEmptyStr
     provider: Optional[Literal["openai", "gemini", "endpoint"]] = None
     model: Optional[str] = None
     input: Dict[str, Any]  # ยอมรับ object อิสระ โดยอย่างน้อยควรมี messages
 
 class RunResponse(BaseModel):
     ok: bool = True
-    result: Dict[str, Any] = {}
+    result: Dict[str, Any] = Field(default_factory=dict)
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 
 # ===== Security / OAuth2 helpers =====
-from jose import jwt
-import requests
+# JWKS / claims cache อยู่ที่ app.jwt_verify (ใช้ชุดเดียวกับ app.main)
+from app import jwt_verify
 
-JWKS_URL = os.getenv("JWKS_URL")              # เช่น https://login.microsoftonline.com/<tenant>/discovery/v2.0/keys
-AUDIENCE  = os.getenv("OAUTH_AUDIENCE")       # client_id / api://<app-id>
-ISSUER    = os.getenv("OAUTH_ISSUER")         # https://login.microsoftonline.com/<tenant>/v2.0
 REQUIRED_SCOPE = "read"
 
-from functools import lru_cache
-@lru_cache(maxsize=1)
-def _jwks():
-    if not JWKS_URL:
-        return None
-    return requests.get(JWKS_URL, timeout=10).json()
+# client เดียวใช้ซ้ำทุก request (pool TCP/TLS) — ไม่บล็อก event loop
+_http = httpx.AsyncClient(timeout=10)
 
-def _decode_bearer(token: str) -> dict:
-    if not JWKS_URL:
+@router.on_event("shutdown")
+async def _close_http():
+    await _http.aclose()
+
+async def _decode_bearer(token: str) -> dict:
+    if not jwt_verify.JWKS_URL:
         # dev mode (ไม่ควรใช้ production)
         return {"scp": "read", "preferred_username": "dev@example.com"}
-    from jose.utils import base64url_decode
-    unverified = jwt.get_unverified_header(token)
-    keys = _jwks().get("keys", [])
-    key = next((k for k in keys if k.get("kid") == unverified.get("kid")), None)
-    if not key:
-        raise HTTPException(status_code=401, detail="Unknown token key id")
-    return jwt.decode(token, key, algorithms=[unverified.get("alg", "RS256")], audience=AUDIENCE, issuer=ISSUER)
+    return await jwt_verify.decode_token(token)
 
 def _require_scope(claims: dict, scope: str):
     scopes = claims.get("scp") or claims.get("scope") or ""
@@ -67,15 +60,16 @@ def _email_from_claims(claims: dict) -> str:
 
 # ===== Entitlement check (เชื่อมกับโมดูลเดิมของ gateway) =====
 from app.enterprise_access import check_access  # สมมุติว่ามีฟังก์ชันลักษณะนี้อยู่แล้ว
+from starlette.concurrency import run_in_threadpool
 
-def _assert_entitled(email: str, agent_slug: str):
-    allowed = check_access(email=email, agent_slug=agent_slug)
-    if not allowed:
+async def _assert_entitled(email: str, agent_slug: str):
+    # check_access เป็น sync (DB) → รันใน threadpool ไม่บล็อก event loop
+    if not await run_in_threadpool(check_access, email=email, agent_slug=agent_slug):
         raise HTTPException(status_code=403, detail=f"Not entitled for agent {agent_slug}")
 
 # ===== Agent registry/runner =====
 from app.runners.agent_runner import AgentRunner  # ตัววิ่งรวม provider ของคุณ
-runner = AgentRunner()
+runner = AgentRunner(http_client=_http)
 
 @router.post("/v1/run", response_model=RunResponse)
 async def run_agent(
@@ -87,14 +81,14 @@ async def run_agent(
     if not authorization or not authorization.lower().startswith("bearer "):
         raise HTTPException(status_code=401, detail="Missing Bearer token")
     token = authorization.split()[1]
-    claims = _decode_bearer(token)
+    claims = await _decode_bearer(token)
     _require_scope(claims, REQUIRED_SCOPE)
 
     # 2) Entitlement (ผูกสิทธิ์กับอีเมลจากโทเค็น)
     email = _email_from_claims(claims)
     if not email:
         raise HTTPException(status_code=401, detail="Email not found in token")
-    _assert_entitled(email, req.agent_slug)
+    await _assert_entitled(email, req.agent_slug)
 
     # 3) Dispatch ไปยังตัว agent ตาม provider/model/messages
     try:
@@ -104,6 +98,9 @@ async def run_agent(
             model_override=req.model,
             payload=req.input                # ภายใน runner รองรับ 'messages' และ keys อื่น ๆ
         )
+    except HTTPException:
+        # 4xx ที่ตั้งใจโยนมา (เช่น auth/entitlement) ต้องคง status เดิม ไม่แปลงเป็น 500
+        raise
     except Exception as e:
         # log error ที่นี่ตามระบบของคุณ
         raise HTTPException(status_code=500, detail=f"Agent error: {e}")
@@ -1,13 +1,16 @@
 # app/auth.py
 import os
+import hmac
 from fastapi import Header, HTTPException
 
+# อ่าน env ครั้งเดียวตอน import (ไม่ต้อง getenv ทุก request)
+_EXPECTED_API_KEY = (os.getenv("API_KEY") or "").encode("utf-8")
+
 def require_api_key(x_api_key: str = Header(None)):
     """ตรวจ API key แบบง่าย ๆ: ถ้าไม่ตั้งค่า API_KEY ใน env จะปล่อยผ่าน"""
-    expected = os.getenv("API_KEY")
-    if not expected:
+    if not _EXPECTED_API_KEY:
         return True
-    if x_api_key != expected:
+    # compare_digest = เทียบแบบ constant-time กัน timing attack
+    if not hmac.compare_digest((x_api_key or "").encode("utf-8"), _EXPECTED_API_KEY):
         raise HTTPException(status_code=401, detail="Invalid API key")
     return True
-
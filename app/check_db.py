@@ -1,26 +1,19 @@
 # check_db.py
-import psycopg2
+import psycopg
 import os
 
-# Direct connection parameters
-DB_PARAMS = {
-    "host": "dpg-d2e1kvbuibrs738im6s0-a.singapore-postgres.render.com",
-    "port": 5432,
-    "dbname": "thanyaaura_entitlement",
-    "user": "thanyaaura_admin",
-    "password": "YdIb7eiPjpYS5VcYfEltdEA2hIrME3mC",  # embedded for check
-    "sslmode": "require",
-}
+# อ่าน connection string จาก env (ห้ามฝังรหัสผ่านไว้ในซอร์ส)
+def _db_url() -> str:
+    url = os.environ.get("DATABASE_URL") or os.environ.get("DB_URL")
+    if not url:
+        raise RuntimeError("DATABASE_URL/DB_URL is not set")
+    return url
 
 def check_connection():
     try:
-        conn = psycopg2.connect(**DB_PARAMS)
-        cur = conn.cursor()
-        cur.execute("SELECT 1;")
-        result = cur.fetchone()
+        with psycopg.connect(_db_url()) as conn:
+            result = conn.execute("SELECT 1;").fetchone()
         print(f"✅ DB connected successfully, SELECT 1 returned: {result[0]}")
-        cur.close()
-        conn.close()
     except Exception as e:
         print(f"❌ DB connection failed: {e}")
 
@@ -1,13 +1,26 @@
 # app/db.py
 import os
+import atexit
+import logging
+import threading
+from functools import lru_cache
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
 import psycopg
-from psycopg.rows import dict_row
+from cachetools import TTLCache
+from psycopg.rows import dict_row, scalar_row
+from psycopg_pool import ConnectionPool, AsyncConnectionPool
+
+log = logging.getLogger("thanyaaura.gateway.db")
 
 # ===== Feature flags (ของเดิม) =====
 # เขียนซ้ำลง subscriptions เพื่อความเข้ากันได้ย้อนหลัง (ค่าเริ่มต้น: เปิด)
 EN_DUAL_WRITE = os.getenv("EN_DUAL_WRITE", "1") == "1"
 # บังคับให้โดเมนหนึ่งมี active ได้ครั้งละ 1 แผน: ปิดตัวอื่นอัตโนมัติ (ค่าเริ่มต้น: เปิด)
 EN_DEACTIVATE_OTHERS = os.getenv("EN_DEACTIVATE_OTHERS", "1") == "1"
+# ปิดแผนอื่นแบบ async: webhook แค่เข้าคิว pending_deactivations แล้วให้ worker (app.deact_worker) ทำ UPDATE
+# เปิดเฉพาะเมื่อรัน worker แล้วเท่านั้น (ค่าเริ่มต้น: ปิด = UPDATE ในคำสั่งเดียวกับ webhook ตามเดิม)
+EN_DEACTIVATE_ASYNC = os.getenv("EN_DEACTIVATE_ASYNC", "0") == "1"
 
 # ===== New: table names (เผื่อ future rename) =====
 TBL_TENANTS          = os.getenv("TBL_TENANTS", "tenants")
@@ -16,28 +29,166 @@ TBL_SUBS_ENT         = os.getenv("TBL_SUBS_ENT", "ent_subscriptions")     # แ
 TBL_USAGE            = os.getenv("TBL_USAGE", "usage_counters")           # calls/yyyymm
 TBL_IDEM             = os.getenv("TBL_IDEM", "idempotency_keys")
 
+# ===== Connection pool =====
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "2"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+PG_APOOL_MAX = int(os.getenv("PG_APOOL_MAX", "20"))
+# รอยืม connection ได้ไม่เกิน N วินาที (pool เต็ม → PoolTimeout แทนการค้างเงียบ ๆ)
+PG_POOL_TIMEOUT = float(os.getenv("PG_POOL_TIMEOUT", "10"))
+# connection ที่ว่างเกิน N วินาที (และเกิน min_size) จะถูกปิดคืน DB
+PG_POOL_MAX_IDLE = float(os.getenv("PG_POOL_MAX_IDLE", "300"))
+# คำสั่งที่รันบน connection เดิมเกิน N ครั้งจะถูก PREPARE ไว้ฝั่ง server (ตัด parse/plan)
+# 0 = prepare ตั้งแต่ครั้งแรก: SQL ทุกตัวเป็นค่าคงที่ระดับโมดูล (_SQL_*) จำนวนจำกัด จึงไม่บวม cache
+# ข้อควรระวัง: คำสั่งที่มีหลาย statement ในสตริงเดียว (เช่น SCHEMA_DDL) prepare ไม่ได้ → ต้องส่ง prepare=False
+# ตั้งเป็นค่าว่างเพื่อปิด
+_PREPARE_ENV = os.getenv("PG_PREPARE_THRESHOLD", "0").strip()
+PG_PREPARE_THRESHOLD = int(_PREPARE_ENV) if _PREPARE_ENV else None
+# วางหลัง connection pooler โหมด transaction (PgBouncer/Supabase pooler ฯลฯ): แต่ละ transaction อาจได้
+# server connection คนละตัว → prepared statement ที่ psycopg จำไว้ไม่มีอยู่จริง ("prepared statement ... does not exist")
+# จึงปิด prepare อัตโนมัติ (autocommit เปิดอยู่แล้ว ไม่มี BEGIN/COMMIT เกินให้ pooler)
+DB_POOLER = os.getenv("DB_POOLER", "session").strip().lower()
+if DB_POOLER == "transaction":
+    PG_PREPARE_THRESHOLD = None
+# autocommit: คำสั่งเดี่ยวเป็น transaction ของตัวเอง (ไม่มี BEGIN/COMMIT แยก)
+# ฟังก์ชันที่ต้อง atomic หลายคำสั่งใช้ `with conn.transaction():` เอง
+_CONN_KWARGS = {"row_factory": dict_row, "prepare_threshold": PG_PREPARE_THRESHOLD, "autocommit": True}
+
 # ---------- Connection ----------
-def _connect():
+_POOL: ConnectionPool | None = None
+_POOL_LOCK = threading.Lock()
+
+def _db_url() -> str:
     url = os.environ.get("DATABASE_URL") or os.environ.get("DB_URL")
     if not url:
         raise RuntimeError("DATABASE_URL/DB_URL is not set")
-    return psycopg.connect(url, row_factory=dict_row)
+    return url
+
+def _get_pool() -> ConnectionPool:
+    """
+    pool ระดับ process สร้างแบบ lazy ตอนใช้ครั้งแรก
+    (import ไม่ต้องต่อ DB และแต่ละ worker หลัง fork ได้ pool ของตัวเอง)
+    """
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = ConnectionPool(
+                    conninfo=_db_url(),
+                    min_size=PG_POOL_MIN,
+                    max_size=PG_POOL_MAX,
+                    timeout=PG_POOL_TIMEOUT,
+                    max_idle=PG_POOL_MAX_IDLE,
+                    kwargs=_CONN_KWARGS,
+                    open=True,
+                )
+    return _POOL
+
+def close_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.close()
+            _POOL = None
+
+# process ที่ไม่มี shutdown hook (scheduler, deact_worker, สคริปต์) ก็ปิด pool ให้เรียบร้อยตอนจบ
+atexit.register(close_pool)
+
+def reset_pool_after_fork():
+    """
+    เรียกใน worker หลัง fork (gunicorn post_fork): ทิ้ง pool ที่ติดมาจาก master
+    โดยไม่ปิด socket ที่แชร์กับ process อื่น แล้วให้ _get_pool() สร้างใหม่เอง
+    """
+    global _POOL, _POOL_LOCK
+    _POOL = None
+    _POOL_LOCK = threading.Lock()
+
+def _connect():
+    """
+    ยืม connection จาก pool (context manager เดิม: `with _connect() as conn`)
+    ออกจาก block → คืน pool (ไม่ได้ปิด TCP/TLS ทิ้ง); connection เป็น autocommit
+    """
+    return _get_pool().connection()
+
+# ---------- Async pool (ใช้ใน route async ของ FastAPI ไม่ต้องยึด threadpool) ----------
+_APOOL: AsyncConnectionPool | None = None
+
+async def _get_apool() -> AsyncConnectionPool:
+    """
+    สร้างใน event loop ที่กำลังรัน (ครั้งแรกที่ถูกเรียก) — open() เรียกซ้ำได้ ไม่เปิดซ้ำ
+    """
+    global _APOOL
+    if _APOOL is None:
+        _APOOL = AsyncConnectionPool(
+            conninfo=_db_url(),
+            min_size=PG_POOL_MIN,
+            max_size=PG_APOOL_MAX,
+            timeout=PG_POOL_TIMEOUT,
+            max_idle=PG_POOL_MAX_IDLE,
+            kwargs=_CONN_KWARGS,
+            open=False,
+        )
+    await _APOOL.open()
+    return _APOOL
+
+async def aclose_pool():
+    global _APOOL
+    if _APOOL is not None:
+        pool, _APOOL = _APOOL, None
+        await pool.close()
+
+# ---------- Entitlement read cache ----------
+# ผลอ่านสิทธิ์ (ต่อ email / ต่อโดเมน) เปลี่ยนเฉพาะตอนมี webhook → cache สั้น ๆ ใน process
+# ทุกฟังก์ชันเขียน (upsert_*/cancel_subscription) จะเรียก invalidate_entitlement() ให้เอง
+ENT_TTL = int(os.getenv("ENT_TTL", "30"))
+_ENT_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=ENT_TTL)
+_ENT_LOCK = threading.RLock()
+_MISS = object()
+
+def _ent_cache_get(key):
+    with _ENT_LOCK:
+        return _ENT_CACHE.get(key, _MISS)
+
+def _ent_cache_set(key, value):
+    with _ENT_LOCK:
+        _ENT_CACHE[key] = value
+
+def invalidate_entitlement(email: str | None = None, domain: str | None = None):
+    """
+    ล้าง cache ของ email/โดเมนที่ระบุ (ไม่ระบุทั้งคู่ = ล้างทั้งหมด)
+    หมายเหตุ: มีผลเฉพาะ process นี้ — worker อื่นจะหมดอายุเองภายใน ENT_TTL วินาที
+    """
+    with _ENT_LOCK:
+        if email is None and domain is None:
+            _ENT_CACHE.clear()
+            return
+        if email:
+            email = email.lower().strip()
+            _ENT_CACHE.pop(("agents", email), None)
+            _ENT_CACHE.pop(("enterprise_email", email), None)
+            if "@" in email:
+                domain = domain or email.split("@", 1)[1]
+        if domain:
+            domain = domain.lower().strip()
+            _ENT_CACHE.pop(("domain", domain), None)
+            _ENT_CACHE.pop(("enterprise", domain), None)
+            # ผล enterprise ต่อ email ขึ้นกับ license ของโดเมนด้วย → ล้างทุก email ใต้โดเมนนี้
+            suffix = "@" + domain
+            for key in [k for k in _ENT_CACHE if k[0] == "enterprise_email" and k[1].endswith(suffix)]:
+                _ENT_CACHE.pop(key, None)
 
 # ---------- Helpers ----------
 def _upsert(sql: str, params: tuple) -> bool:
     try:
         with _connect() as conn, conn.cursor() as cur:
             cur.execute(sql, params)
-            conn.commit()
             return True
-    except Exception as ex:
-        print(f"DB error: {ex}")
+    except Exception:
+        log.exception("DB error")
         return False
 
 def _exec(sql: str, params: tuple | None = None):
     with _connect() as conn, conn.cursor() as cur:
         cur.execute(sql, params or ())
-        conn.commit()
 
 def _fetchone(sql: str, params: tuple | None = None):
     with _connect() as conn, conn.cursor() as cur:
@@ -49,67 +200,275 @@ def _fetchall(sql: str, params: tuple | None = None):
         cur.execute(sql, params or ())
         return cur.fetchall()
 
-# ---------- Ensure quota schema (lazy) ----------
+def _fetchval(sql: str, params: tuple | None = None):
+    """คืนค่าคอลัมน์แรกของแถวแรก (None ถ้าไม่มีแถว) — ไม่สร้าง dict ต่อแถว"""
+    with _connect() as conn, conn.cursor(row_factory=scalar_row) as cur:
+        cur.execute(sql, params or ())
+        return cur.fetchone()
+
+async def _aupsert(sql: str, params: tuple) -> bool:
+    try:
+        pool = await _get_apool()
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(sql, params)
+            return True
+    except Exception:
+        log.exception("DB error")
+        return False
+
+async def _aexec(sql: str, params: tuple | None = None):
+    pool = await _get_apool()
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(sql, params or ())
+
+def upsert_many(calls) -> bool:
+    """
+    รันหลายคำสั่งเขียน [(sql, params), ...] ใน transaction เดียวผ่าน pipeline mode
+    (ส่งทุกคำสั่ง + COMMIT ใน network flush เดียว แทนรอผลทีละคำสั่ง) — ล้มหนึ่งคำสั่ง = rollback ทั้งชุด
+    คำสั่งเดี่ยวไม่ต้องใช้: connection เป็น autocommit อยู่แล้ว (1 round-trip ต่อคำสั่ง)
+    """
+    if not calls:
+        return True
+    try:
+        with _connect() as conn, conn.pipeline(), conn.transaction():
+            for sql, params in calls:
+                conn.execute(sql, params)
+        return True
+    except Exception:
+        log.exception("DB error upsert_many")
+        return False
+
+async def aupsert_many(calls) -> bool:
+    """async sibling ของ upsert_many"""
+    if not calls:
+        return True
+    try:
+        pool = await _get_apool()
+        async with pool.connection() as conn, conn.pipeline(), conn.transaction():
+            for sql, params in calls:
+                await conn.execute(sql, params)
+        return True
+    except Exception:
+        log.exception("DB error aupsert_many")
+        return False
+
+# สิทธิ์ 'all' = agent ครบทั้ง 33 ตัว (สร้างครั้งเดียวตอน import)
+_ALL_AGENTS: tuple[str, ...] = (
+    "budget_standard", "budget_plus", "budget_premium",
+    "capex_standard", "capex_plus", "capex_premium",
+    "cost_standard", "cost_plus", "cost_premium",
+    "decision_standard", "decision_plus", "decision_premium",
+    "enterprise_cf", "project_cf", "single_cf",
+    "forecast_standard", "forecast_plus", "forecast_premium",
+    "fx_standard", "fx_plus", "fx_premium",
+    "margin_standard", "margin_plus", "margin_premium",
+    "report_standard", "report_plus", "report_premium",
+    "revenue_standard", "revenue_intermediate", "revenue_advance",
+    "variance_standard", "variance_plus", "variance_premium",
+)
+_ALL_AGENTS_SQL = "ARRAY[" + ", ".join(f"'{a}'" for a in _ALL_AGENTS) + "]::text[]"
+
+# ช่อง LISTEN/NOTIFY ของคิว pending_deactivations
+DEACT_CHANNEL = "pending_deact"
+
+# ---------- Schema migration (startup-only) ----------
+# DDL ทั้งหมดรวมเป็นสคริปต์เดียว → ส่งครั้งเดียว (1 round-trip แทน 5)
+SCHEMA_DDL = f"""
+    CREATE TABLE IF NOT EXISTS {TBL_TENANTS} (
+      id BIGSERIAL PRIMARY KEY,
+      name TEXT NOT NULL,
+      status TEXT NOT NULL DEFAULT 'active',
+      created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    CREATE TABLE IF NOT EXISTS {TBL_API_KEYS} (
+      id BIGSERIAL PRIMARY KEY,
+      tenant_id BIGINT NOT NULL REFERENCES {TBL_TENANTS}(id) ON DELETE CASCADE,
+      key_hash CHAR(64) NOT NULL UNIQUE,
+      active BOOLEAN NOT NULL DEFAULT TRUE,
+      expires_at TIMESTAMPTZ,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    CREATE TABLE IF NOT EXISTS {TBL_SUBS_ENT} (
+      tenant_id BIGINT NOT NULL REFERENCES {TBL_TENANTS}(id) ON DELETE CASCADE,
+      plan_code TEXT NOT NULL,                     -- ENT_STANDARD / ENT_PLUS / ENT_PRO
+      monthly_quota INT NOT NULL,
+      extra_quota_balance INT NOT NULL DEFAULT 0,  -- โควตาซื้อเพิ่มคงเหลือ (add-on)
+      renew_day SMALLINT NOT NULL DEFAULT 1,       -- 1..28 (วันตัดรอบ)
+      status TEXT NOT NULL DEFAULT 'active',
+      created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+      updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+      PRIMARY KEY (tenant_id)
+    );
+    CREATE TABLE IF NOT EXISTS {TBL_USAGE} (
+      tenant_id BIGINT NOT NULL REFERENCES {TBL_TENANTS}(id) ON DELETE CASCADE,
+      period_yyyymm CHAR(7) NOT NULL,              -- 'YYYY-MM'
+      calls_used INT NOT NULL DEFAULT 0,
+      PRIMARY KEY (tenant_id, period_yyyymm)
+    );
+    CREATE TABLE IF NOT EXISTS {TBL_IDEM} (
+      tenant_id BIGINT NOT NULL REFERENCES {TBL_TENANTS}(id) ON DELETE CASCADE,
+      idem_key TEXT NOT NULL,
+      created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+      PRIMARY KEY (tenant_id, idem_key)
+    );
+    -- คิวงานปิดแผนเก่าของโดเมน (EN_DEACTIVATE_ASYNC) — insert แล้ว trigger ส่ง NOTIFY ปลุก worker
+    CREATE TABLE IF NOT EXISTS pending_deactivations (
+      id BIGSERIAL PRIMARY KEY,
+      domain TEXT NOT NULL,
+      active_sku TEXT NOT NULL,
+      queued_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+    CREATE OR REPLACE FUNCTION pending_deactivations_notify()
+    RETURNS trigger LANGUAGE plpgsql AS $fn$
+    BEGIN
+      PERFORM pg_notify('{DEACT_CHANNEL}', '');
+      RETURN NULL;
+    END
+    $fn$;
+    DO $$
+    BEGIN
+      IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'pending_deactivations_notify_trg') THEN
+        CREATE TRIGGER pending_deactivations_notify_trg
+          AFTER INSERT ON pending_deactivations
+          FOR EACH STATEMENT EXECUTE FUNCTION pending_deactivations_notify();
+      END IF;
+    END $$;
+    -- index บน subscriptions / enterprise_licenses (ตารางที่มีข้อมูลจริง) สร้างแยกใน _ensure_indexes() แบบ CONCURRENTLY
+    DO $$
+    BEGIN
+      IF to_regclass('subscriptions') IS NOT NULL THEN
+        -- สิทธิ์ที่มีผลของผู้ใช้: ถ้ามีแถว 'all' ที่ active → agent ครบทุกตัว (ขยายฝั่ง DB)
+        CREATE OR REPLACE FUNCTION effective_agents(p_email TEXT)
+        RETURNS TABLE (sku TEXT) LANGUAGE sql STABLE AS $fn$
+          WITH act AS (
+            SELECT s.sku::text AS sku
+              FROM subscriptions s
+             WHERE s.user_email = p_email
+               AND s.status = 'active'
+          )
+          SELECT unnest({_ALL_AGENTS_SQL}) WHERE EXISTS (SELECT 1 FROM act WHERE act.sku = 'all')
+          UNION ALL
+          SELECT act.sku FROM act WHERE NOT EXISTS (SELECT 1 FROM act a2 WHERE a2.sku = 'all')
+        $fn$;
+      END IF;
+    END $$;
+"""
+
+_MIGRATED = False
+_MIGRATE_LOCK = threading.Lock()
+
 def _ensure_quota_schema():
     """
     สร้างตารางที่จำเป็นสำหรับ Thin API quota/plan หากยังไม่มี
     - tenants, api_keys, ent_subscriptions, usage_counters, idempotency_keys
+    ทำจริงครั้งเดียวต่อ process (สำเร็จแล้วครั้งต่อไปเป็น no-op)
     """
-    with _connect() as conn, conn.cursor() as cur:
-        cur.execute(f"""
-            CREATE TABLE IF NOT EXISTS {TBL_TENANTS} (
-              id BIGSERIAL PRIMARY KEY,
-              name TEXT NOT NULL,
-              status TEXT NOT NULL DEFAULT 'active',
-              created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            );
-        """)
-        cur.execute(f"""
-            CREATE TABLE IF NOT EXISTS {TBL_API_KEYS} (
-              id BIGSERIAL PRIMARY KEY,
-              tenant_id BIGINT NOT NULL REFERENCES {TBL_TENANTS}(id) ON DELETE CASCADE,
-              key_hash CHAR(64) NOT NULL UNIQUE,
-              active BOOLEAN NOT NULL DEFAULT TRUE,
-              expires_at TIMESTAMPTZ,
-              created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            );
-        """)
-        cur.execute(f"""
-            CREATE TABLE IF NOT EXISTS {TBL_SUBS_ENT} (
-              tenant_id BIGINT NOT NULL REFERENCES {TBL_TENANTS}(id) ON DELETE CASCADE,
-              plan_code TEXT NOT NULL,                     -- ENT_STANDARD / ENT_PLUS / ENT_PRO
-              monthly_quota INT NOT NULL,
-              extra_quota_balance INT NOT NULL DEFAULT 0,  -- โควตาซื้อเพิ่มคงเหลือ (add-on)
-              renew_day SMALLINT NOT NULL DEFAULT 1,       -- 1..28 (วันตัดรอบ)
-              status TEXT NOT NULL DEFAULT 'active',
-              created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-              updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-              PRIMARY KEY (tenant_id)
-            );
-        """)
-        cur.execute(f"""
-            CREATE TABLE IF NOT EXISTS {TBL_USAGE} (
-              tenant_id BIGINT NOT NULL REFERENCES {TBL_TENANTS}(id) ON DELETE CASCADE,
-              period_yyyymm CHAR(7) NOT NULL,              -- 'YYYY-MM'
-              calls_used INT NOT NULL DEFAULT 0,
-              PRIMARY KEY (tenant_id, period_yyyymm)
-            );
-        """)
-        cur.execute(f"""
-            CREATE TABLE IF NOT EXISTS {TBL_IDEM} (
-              tenant_id BIGINT NOT NULL REFERENCES {TBL_TENANTS}(id) ON DELETE CASCADE,
-              idem_key TEXT NOT NULL,
-              created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-              PRIMARY KEY (tenant_id, idem_key)
-            );
-        """)
-        conn.commit()
+    global _MIGRATED
+    if _MIGRATED:
+        return
+    with _MIGRATE_LOCK:
+        if _MIGRATED:
+            return
+        with _connect() as conn, conn.transaction():
+            # หลายคำสั่งในครั้งเดียวต้องส่งแบบ simple query: prepare=False บังคับไม่ให้ PREPARE
+            # (PG_PREPARE_THRESHOLD=0 จะ prepare ตั้งแต่ครั้งแรก → "cannot insert multiple commands into a prepared statement")
+            # timeout กัน migration ค้าง (รอ lock ตาราง) จนแอปสตาร์ตไม่ขึ้น
+            conn.execute(
+                "SET LOCAL lock_timeout = '2s'; SET LOCAL statement_timeout = '10s';" + SCHEMA_DDL,
+                prepare=False,
+            )
+        _MIGRATED = True
+
+# ---------- Index migration (นอก transaction ของ SCHEMA_DDL) ----------
+# index บนตารางที่มีข้อมูลจริง: CREATE INDEX CONCURRENTLY ไม่บล็อกการเขียน และต้องรันนอก transaction
+# แต่ละตัวเป็นคำสั่ง autocommit ของตัวเอง → ตัวหนึ่งล้มไม่ดึงตาราง/ฟังก์ชันอื่นใน SCHEMA_DDL ถอยกลับ
+# (table, index name, ส่วนหลัง ON)
+_INDEX_DDL = (
+    # fallback หา enterprise ตามโดเมนใน subscriptions: query ใช้ expression เดียวกันนี้ (index probe แทน seq scan)
+    ("subscriptions", "subscriptions_email_domain_expr_idx",
+     "subscriptions (lower(split_part(user_email, '@', 2))) WHERE status = 'active'"),
+    ("subscriptions", "subscriptions_trial_created_idx",
+     "subscriptions (created_at) WHERE sku = 'trial' AND status = 'active'"),
+    # covering index: ค้นสิทธิ์ตาม (user_email, status) ได้ sku/platform จาก index เลย (index-only scan)
+    ("subscriptions", "subscriptions_user_status_idx",
+     "subscriptions (user_email, status) INCLUDE (sku, platform)"),
+    ("enterprise_licenses", "enterprise_licenses_domain_idx",
+     "enterprise_licenses (domain) INCLUDE (sku, tier_code, active, activated_at)"),
+)
+
+# (ตารางมีอยู่ไหม, index valid ไหม — NULL = ยังไม่มี index)
+_SQL_INDEX_STATE = """
+    SELECT to_regclass(%s) IS NOT NULL,
+           (SELECT i.indisvalid FROM pg_index i WHERE i.indexrelid = to_regclass(%s));
+"""
+# worker หลายตัวสตาร์ตพร้อมกัน → ให้ตัวเดียวสร้าง index ที่เหลือข้าม (lock ระดับ session ปลดเองเมื่อปิด connection)
+_SQL_INDEX_LOCK = "SELECT pg_try_advisory_lock(hashtext('thanyaaura.index_migration'));"
+
+def _ensure_indexes():
+    """
+    สร้าง index ใน _INDEX_DDL ที่ยังไม่มี (CONCURRENTLY, ทีละตัว, best-effort)
+    ใช้ connection แยกจาก pool: SET ระดับ session (timeout) ไม่รั่วไปยัง connection ใน pool
+    """
+    with psycopg.connect(_db_url(), autocommit=True) as conn:
+        if not conn.execute(_SQL_INDEX_LOCK).fetchone()[0]:
+            log.info("Index migration running in another process; skipping.")
+            return
+        # รอ lock ตารางไม่เกิน 2s; ตัว build อาจนานบนตารางใหญ่ → ไม่จำกัด statement_timeout
+        conn.execute("SET lock_timeout = '2s'")
+        conn.execute("SET statement_timeout = 0")
+        for table, name, target in _INDEX_DDL:
+            try:
+                has_table, valid = conn.execute(_SQL_INDEX_STATE, (table, name)).fetchone()
+                if not has_table or valid:
+                    continue
+                if valid is False:
+                    # build CONCURRENTLY ที่ล้มค้างไว้เป็น index INVALID → IF NOT EXISTS จะข้ามตลอด ต้องลบก่อน
+                    conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {target}")
+                log.info("Created index %s", name)
+            except Exception:
+                log.exception("Index migration failed for %s", name)
+
+def migrate() -> None:
+    """
+    รัน schema migration ครั้งเดียวตอนสตาร์ต (เรียกจาก startup ของ app.main)
+    ฟังก์ชันใน request path จึงไม่ต้อง ensure schema เองอีก
+    """
+    _ensure_quota_schema()
+    _ensure_indexes()
 
 # ---------- Health ----------
+# health check ไม่ควรรอ pool นาน: ยืม connection ไม่ได้ภายใน N วินาที = ไม่พร้อม
+PING_TIMEOUT = float(os.getenv("DB_PING_TIMEOUT", "2"))
+
 def ping_db():
     try:
-        with _connect() as conn, conn.cursor() as cur:
-            cur.execute("SELECT 1;")
+        with _get_pool().connection(timeout=PING_TIMEOUT) as conn:
+            conn.execute("SELECT 1;")
+            return True
+    except Exception:
+        return False
+
+async def aping_db():
+    try:
+        pool = await _get_apool()
+        async with pool.connection(timeout=PING_TIMEOUT) as conn:
+            await conn.execute("SELECT 1;")
+            return True
+    except Exception:
+        return False
+
+def readiness_db():
+    """
+    ตรวจลึกกว่า ping_db: อ่านตาราง subscriptions จริงภายใต้ statement_timeout สั้น ๆ
+    DB ช้า → ตอบ False เร็ว แทนที่จะทำให้ probe ค้าง
+    """
+    try:
+        with _get_pool().connection(timeout=PING_TIMEOUT) as conn, conn.transaction():
+            conn.execute("SET LOCAL statement_timeout = '500ms';")
+            conn.execute("SELECT 1 FROM subscriptions LIMIT 1;")
             return True
     except Exception:
         return False
@@ -117,6 +476,24 @@ def ping_db():
 # ======================================================================
 # Existing (เดิม) — Subscriptions / Entitlements ที่ใช้กับ webhook ตัวเก่า
 # ======================================================================
+@lru_cache(maxsize=512)
+def _sub_tail(part, platform) -> str:
+    # sku/tier x platform เป็นชุดจำกัด (33 agent + tier x 3 platform) → lower + join ครั้งเดียวแล้วจำไว้
+    return f"{part}-{platform}".lower()
+
+def _sub_id(prefix: str, order_id, part, platform) -> str:
+    """id ของแถว subscriptions: '<prefix>-<order>-<sku|tier>-<platform>' (ตัวพิมพ์เล็ก)"""
+    return f"{prefix}-{str(order_id).lower()}-{_sub_tail(part, platform)}"
+
+_SQL_UPSERT_SUB = """
+    INSERT INTO subscriptions (id, user_email, sku, platform, status, created_at, updated_at)
+    VALUES (%s, %s, %s, %s, %s, now(), now())
+    ON CONFLICT (id)
+    DO UPDATE SET platform   = EXCLUDED.platform,
+                  status     = EXCLUDED.status,
+                  updated_at = now();
+"""
+
 def upsert_subscription_and_entitlement(
     order_id: str,
     user_email: str,
@@ -129,16 +506,102 @@ def upsert_subscription_and_entitlement(
     Store subscription for a specific agent purchase.
     ID is tied to order to avoid collision on repeat buys.
     """
-    sub_id = f"tc-agent-{order_id}-{sku}-{platform}".lower()
-    sql = """
-        INSERT INTO subscriptions (id, user_email, sku, platform, status, created_at, updated_at)
-        VALUES (%s, %s, %s, %s, %s, now(), now())
-        ON CONFLICT (id)
-        DO UPDATE SET platform   = EXCLUDED.platform,
-                      status     = EXCLUDED.status,
-                      updated_at = now();
+    sub_id = _sub_id("tc-agent", order_id, sku, platform)
+    ok = _upsert(_SQL_UPSERT_SUB, (sub_id, user_email, sku, platform, status))
+    invalidate_entitlement(email=user_email)
+    return ok
+
+BULK_COPY_MIN = int(os.getenv("BULK_COPY_MIN", "1000"))
+
+# ส่งแต่ละคอลัมน์เป็น array พารามิเตอร์เดียว → ข้อความ SQL คงที่ทุกขนาดชุด (prepared statement ตัวเดียว)
+_SQL_UPSERT_SUB_MANY = """
+    INSERT INTO subscriptions (id, user_email, sku, platform, status, created_at, updated_at)
+    SELECT id, user_email, sku, platform, status, now(), now()
+      FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[], %s::text[])
+           AS v(id, user_email, sku, platform, status)
+    ON CONFLICT (id)
+    DO UPDATE SET platform   = EXCLUDED.platform,
+                  status     = EXCLUDED.status,
+                  updated_at = now();
+"""
+
+def upsert_subscriptions_bulk(rows: list[tuple[str, str, str, str, str]], use_copy: bool | None = None) -> bool:
     """
-    return _upsert(sql, (sub_id, user_email, sku, platform, status))
+    upsert แถว subscriptions ที่มี id แล้ว: [(sub_id, user_email, sku, platform, status), ...]
+    - ชุดเล็ก: INSERT ... SELECT FROM unnest(arrays) ... ON CONFLICT คำสั่งเดียว
+    - ชุดใหญ่ (>= BULK_COPY_MIN หรือ use_copy=True): COPY เข้า temp table แล้ว INSERT ... SELECT ... ON CONFLICT ครั้งเดียว
+    id ซ้ำในชุดเดียวกัน: ใช้แถวหลังสุด (ON CONFLICT แก้แถวเดียวซ้ำในคำสั่งเดียวไม่ได้)
+    """
+    if not rows:
+        return True
+    rows = list({r[0]: r for r in rows}.values())
+    if use_copy is None:
+        use_copy = len(rows) >= BULK_COPY_MIN
+    try:
+        with _connect() as conn, conn.transaction(), conn.cursor() as cur:
+            if not use_copy:
+                cur.execute(_SQL_UPSERT_SUB_MANY, [list(col) for col in zip(*rows)])
+            else:
+                cur.execute("""
+                    CREATE TEMP TABLE _bulk_subs (
+                      id TEXT, user_email TEXT, sku TEXT, platform TEXT, status TEXT
+                    ) ON COMMIT DROP;
+                """)
+                with cur.copy("COPY _bulk_subs (id, user_email, sku, platform, status) FROM STDIN") as cp:
+                    for r in rows:
+                        cp.write_row(r)
+                cur.execute("""
+                    INSERT INTO subscriptions (id, user_email, sku, platform, status, created_at, updated_at)
+                    SELECT id, user_email, sku, platform, status, now(), now()
+                      FROM _bulk_subs
+                    ON CONFLICT (id)
+                    DO UPDATE SET platform   = EXCLUDED.platform,
+                                  status     = EXCLUDED.status,
+                                  updated_at = now();
+                """)
+        ok = True
+    except Exception:
+        log.exception("DB error upsert_subscriptions_bulk")
+        ok = False
+    for email in {r[1] for r in rows}:
+        invalidate_entitlement(email=email)
+    return ok
+
+def bulk_upsert_subscriptions(rows: list[tuple[str, str, str, str, str]]) -> bool:
+    """
+    upsert สิทธิ์ agent หลายรายการในครั้งเดียว (เช่น enterprise order ที่ลงทะเบียนผู้ใช้หลายคน)
+    rows: [(order_id, user_email, sku, platform, status), ...] — sub_id สร้างแบบเดียวกับ upsert_subscription_and_entitlement
+    """
+    return upsert_subscriptions_bulk([
+        (_sub_id("tc-agent", order_id, sku, platform), user_email, sku, platform, status)
+        for order_id, user_email, sku, platform, status in rows
+    ])
+
+def bulk_grant_all_agents(emails: list[str], platform: str, status: str = "active") -> bool:
+    """
+    ให้สิทธิ์ agent ครบ 33 ตัว (_ALL_AGENTS) แบบแยกแถวต่อ agent ให้หลายอีเมลในครั้งเดียว
+    (seed/backfill) — ส่งผ่าน COPY เสมอ เพราะจำนวนแถว = len(emails) x 33
+    """
+    rows = [
+        (_sub_id("perm", email, slug, platform), email, slug, platform, status)
+        for email in emails
+        for slug in _ALL_AGENTS
+    ]
+    return upsert_subscriptions_bulk(rows, use_copy=True)
+
+async def aupsert_subscription_and_entitlement(
+    order_id: str,
+    user_email: str,
+    sku: str,
+    agent_slug: str | None,
+    platform: str,
+    status: str = "active",
+):
+    """async sibling ของ upsert_subscription_and_entitlement"""
+    sub_id = _sub_id("tc-agent", order_id, sku, platform)
+    ok = await _aupsert(_SQL_UPSERT_SUB, (sub_id, user_email, sku, platform, status))
+    invalidate_entitlement(email=user_email)
+    return ok
 
 def upsert_tier_subscription(
     order_id: str,
@@ -151,38 +614,96 @@ def upsert_tier_subscription(
     """
     Store subscription for tier plans (Standard / Plus / Premium).
     """
-    sub_id = f"tc-tier-{order_id}-{tier}-{platform}".lower()
-    sql = """
-        INSERT INTO subscriptions (id, user_email, sku, platform, status, created_at, updated_at)
-        VALUES (%s, %s, %s, %s, %s, now(), now())
-        ON CONFLICT (id)
-        DO UPDATE SET platform   = EXCLUDED.platform,
-                      status     = EXCLUDED.status,
-                      updated_at = now();
-    """
-    return _upsert(sql, (sub_id, user_email, sku, platform, status))
+    sub_id = _sub_id("tc-tier", order_id, tier, platform)
+    ok = _upsert(_SQL_UPSERT_SUB, (sub_id, user_email, sku, platform, status))
+    invalidate_entitlement(email=user_email)
+    return ok
 
-def upsert_enterprise_license(
+async def aupsert_tier_subscription(
     order_id: str,
     user_email: str,
-    sku: str,                 # en_standard | en_professional | en_unlimited
-    agent_slug: str | None,   # ไม่ได้ใช้ แต่คง signature เดิม
+    sku: str,
+    tier: str,
     platform: str,
     status: str = "active",
 ):
+    """async sibling ของ upsert_tier_subscription"""
+    sub_id = _sub_id("tc-tier", order_id, tier, platform)
+    ok = await _aupsert(_SQL_UPSERT_SUB, (sub_id, user_email, sku, platform, status))
+    invalidate_entitlement(email=user_email)
+    return ok
+
+# enterprise sku -> tier_code
+_TIER_FROM_SKU = {
+    "en_standard": "STANDARD",
+    "en_professional": "PROFESSIONAL",
+    "en_unlimited": "UNLIMITED",
+}
+
+# enterprise_licenses + ปิดแผนอื่นของโดเมน + ร่องรอยใน subscriptions
+# รวมเป็นคำสั่งเดียวด้วย writable CTE → 1 round-trip และเขียนทุกตารางแบบ atomic
+# ส่วนที่เป็น option (EN_DEACTIVATE_OTHERS / EN_DUAL_WRITE) คุมด้วยพารามิเตอร์ boolean
+# ข้อความ SQL จึงคงที่เสมอ (prepared statement ตัวเดียว) และไม่ต้องเรียงลำดับ params ตาม flag
+# ส่วนปิดแผนอื่นเลือกตอน import ตาม EN_DEACTIVATE_ASYNC: โหมด sync ไม่อ้างถึง pending_deactivations เลย
+_SQL_ENT_UPSERT_HEAD = """
+    WITH el AS (
+        INSERT INTO enterprise_licenses (domain, sku, tier_code, active, last_order_id, activated_at, expires_at)
+        VALUES (%(domain)s, %(sku)s, %(tier_code)s, TRUE, %(order_id)s, now(), NULL)
+        ON CONFLICT (domain, sku) DO UPDATE
+           SET tier_code     = EXCLUDED.tier_code,
+               active        = TRUE,
+               last_order_id = EXCLUDED.last_order_id,
+               activated_at  = now(),
+               expires_at    = NULL
+        RETURNING sku
+    ),"""
+
+_SQL_ENT_DEACT_NOW = """ deact AS (
+        UPDATE enterprise_licenses
+           SET active = FALSE,
+               expires_at = now()
+         WHERE %(deactivate_others)s
+           AND domain = %(domain)s
+           AND sku <> %(sku)s
+           AND active IS TRUE
+        RETURNING 1
+    )"""
+
+_SQL_ENT_DEACT_QUEUE = """ queued AS (
+        -- โหมด async: แค่เข้าคิว ให้ worker ปิดแผนอื่นทีหลัง (ไม่ถือ lock แถวอื่นของโดเมนใน webhook)
+        INSERT INTO pending_deactivations (domain, active_sku)
+        SELECT %(domain)s, %(sku)s
+         WHERE %(deactivate_others)s
+        RETURNING 1
+    )"""
+
+_SQL_ENT_UPSERT_TAIL = """
+    -- เขียน platform เป็น 'Copilot' ให้เป็นไปตามกติกาเดียวกันเสมอ
+    INSERT INTO subscriptions (id, user_email, sku, platform, status, created_at, updated_at)
+    SELECT %(sub_id)s, %(user_email)s, el.sku, 'Copilot', 'active', now(), now()
+      FROM el
+     WHERE %(dual_write)s
+    ON CONFLICT (id)
+    DO UPDATE SET platform   = EXCLUDED.platform,
+                  status     = EXCLUDED.status,
+                  updated_at = now();
+"""
+
+_SQL_ENT_UPSERT = (
+    _SQL_ENT_UPSERT_HEAD
+    + (_SQL_ENT_DEACT_QUEUE if EN_DEACTIVATE_ASYNC else _SQL_ENT_DEACT_NOW)
+    + _SQL_ENT_UPSERT_TAIL
+)
+
+def _enterprise_license_statements(order_id: str, user_email: str, sku: str, platform: str):
     """
-    บันทึกสิทธิ์ Enterprise ลง enterprise_licenses (แหล่งอ้างอิงหลัก)
-    และเก็บร่องรอยไว้ใน subscriptions ตามเดิม (เพื่อความเข้ากันได้ย้อนหลัง)
-    - มี option ปิดสิทธิ์แผนเก่าในโดเมนเดียวกันให้อัตโนมัติ (EN_DEACTIVATE_OTHERS)
+    คืนรายการ (sql, params) ของ upsert_enterprise_license
+    (ใช้ร่วมกันทั้งเวอร์ชัน sync และ async)
     """
     license_type = (sku or "").strip().lower()
-    tier_map = {
-        "en_standard": "STANDARD",
-        "en_professional": "PROFESSIONAL",
-        "en_unlimited": "UNLIMITED",
-    }
-    tier_code = tier_map.get(license_type)
-    if not tier_code:
+    tier_code = _TIER_FROM_SKU.get(license_type)
+    if tier_code is None:
+        log.warning("unknown enterprise sku: %r", sku)
         raise ValueError(f"bad enterprise sku: {sku!r}")
 
     # ดึงโดเมนจากอีเมลผู้ซื้อ
@@ -191,48 +712,94 @@ def upsert_enterprise_license(
         raise ValueError("bad purchaser email (no domain)")
     domain = email.split("@", 1)[1]
 
-    # 1) อัปเซิร์ตลง enterprise_licenses (ตัวจริงที่ตัว checker ใช้อ่าน)
-    sql_ent = """
-        INSERT INTO enterprise_licenses (domain, sku, tier_code, active, last_order_id, activated_at, expires_at)
-        VALUES (%s, %s, %s, TRUE, %s, now(), NULL)
-        ON CONFLICT (domain, sku) DO UPDATE
-           SET tier_code     = EXCLUDED.tier_code,
-               active        = TRUE,
-               last_order_id = EXCLUDED.last_order_id,
-               activated_at  = now(),
-               expires_at    = NULL;
-    """
-    ok1 = _upsert(sql_ent, (domain, license_type, tier_code, order_id))
-
-    # 1.1) (ทางเลือก) ปิดสิทธิ์ enterprise sku อื่น ๆ ของโดเมนเดียวกัน (เหลือ active แผนล่าสุดเพียงตัวเดียว)
-    ok1b = True
-    if EN_DEACTIVATE_OTHERS:
-        sql_deact = """
-            UPDATE enterprise_licenses
-               SET active = FALSE,
-                   expires_at = now()
-             WHERE domain = %s
-               AND sku <> %s
-               AND active IS TRUE;
-        """
-        ok1b = _upsert(sql_deact, (domain, license_type))
-
-    # 2) (ทางเลือก) เก็บร่องรอยไว้ใน subscriptions (ตามโค้ดเดิม) เพื่อ backward compatibility
-    ok2 = True
-    if EN_DUAL_WRITE:
-        sub_id = f"tc-enterprise-{order_id}-{license_type}-{platform}".lower()
-        sql_sub = """
-            INSERT INTO subscriptions (id, user_email, sku, platform, status, created_at, updated_at)
-            VALUES (%s, %s, %s, %s, %s, now(), now())
-            ON CONFLICT (id)
-            DO UPDATE SET platform   = EXCLUDED.platform,
-                          status     = EXCLUDED.status,
-                          updated_at = now();
-        """
-        # เขียน platform เป็น 'Copilot' ให้เป็นไปตามกติกาเดียวกันเสมอ
-        ok2 = _upsert(sql_sub, (sub_id, user_email, license_type, "Copilot", "active"))
-
-    return bool(ok1 and ok1b and ok2)
+    params = {
+        "domain": domain,
+        "sku": license_type,
+        "tier_code": tier_code,
+        "order_id": order_id,
+        "deactivate_others": EN_DEACTIVATE_OTHERS,
+        "dual_write": EN_DUAL_WRITE,
+        "sub_id": _sub_id("tc-enterprise", order_id, license_type, platform),
+        "user_email": user_email,
+    }
+    return [(_SQL_ENT_UPSERT, params)]
+
+def upsert_enterprise_license(
+    order_id: str,
+    user_email: str,
+    sku: str,                 # en_standard | en_professional | en_unlimited
+    agent_slug: str | None,   # ไม่ได้ใช้ แต่คง signature เดิม
+    platform: str,
+    status: str = "active",
+):
+    """
+    บันทึกสิทธิ์ Enterprise ลง enterprise_licenses (แหล่งอ้างอิงหลัก)
+    และเก็บร่องรอยไว้ใน subscriptions ตามเดิม (เพื่อความเข้ากันได้ย้อนหลัง)
+    - มี option ปิดสิทธิ์แผนเก่าในโดเมนเดียวกันให้อัตโนมัติ (EN_DEACTIVATE_OTHERS)
+    """
+    stmts = _enterprise_license_statements(order_id, user_email, sku, platform)
+    results = [_upsert(sql, params) for sql, params in stmts]
+    invalidate_entitlement(email=user_email)
+    return all(results)
+
+async def aupsert_enterprise_license(
+    order_id: str,
+    user_email: str,
+    sku: str,
+    agent_slug: str | None,
+    platform: str,
+    status: str = "active",
+):
+    """async sibling ของ upsert_enterprise_license"""
+    stmts = _enterprise_license_statements(order_id, user_email, sku, platform)
+    results = [await _aupsert(sql, params) for sql, params in stmts]
+    invalidate_entitlement(email=user_email)
+    return all(results)
+
+# --- คิวปิดแผนเก่า (EN_DEACTIVATE_ASYNC) ---
+DEACT_BATCH = int(os.getenv("DEACT_BATCH", "1000"))
+
+# ดึงงานจากคิวทีละ batch (SKIP LOCKED → รันหลาย worker พร้อมกันได้) แล้วปิดแผนอื่นของโดเมนในคำสั่งเดียว
+# activated_at <= queued_at: ไม่ปิดแผนที่ถูกเปิดหลังงานนั้นเข้าคิว (กรณีซื้อหลายแผนติดกัน)
+_SQL_DRAIN_DEACT = """
+    WITH c AS (
+        DELETE FROM pending_deactivations
+         WHERE id IN (
+               SELECT id FROM pending_deactivations
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+         )
+        RETURNING domain, active_sku, queued_at
+    ), upd AS (
+        UPDATE enterprise_licenses e
+           SET active = FALSE,
+               expires_at = now()
+          FROM c
+         WHERE e.domain = c.domain
+           AND e.sku <> c.active_sku
+           AND e.active IS TRUE
+           AND e.activated_at <= c.queued_at
+        RETURNING e.domain
+    )
+    SELECT (SELECT count(*) FROM c) AS drained,
+           ARRAY(SELECT DISTINCT domain FROM upd) AS domains;
+"""
+
+def drain_pending_deactivations(batch: int = DEACT_BATCH) -> int:
+    """
+    ทำงานในคิว pending_deactivations จนหมด (ทีละ batch, batch ละ 1 transaction)
+    RETURN: จำนวนงานที่ทำไป
+    """
+    total = 0
+    while True:
+        with _connect() as conn, conn.transaction():
+            row = conn.execute(_SQL_DRAIN_DEACT, (batch,)).fetchone()
+        for d in row["domains"] or ():
+            invalidate_entitlement(domain=d)
+        total += row["drained"]
+        if row["drained"] < batch:
+            return total
 
 def cancel_subscription(user_email: str, sku: str | None = None):
     """
@@ -240,62 +807,138 @@ def cancel_subscription(user_email: str, sku: str | None = None):
     """
     if sku:
         sql = "UPDATE subscriptions SET status = 'cancelled', updated_at = now() WHERE user_email = %s AND sku = %s"
-        return _upsert(sql, (user_email, sku))
+        ok = _upsert(sql, (user_email, sku))
     else:
         sql = "UPDATE subscriptions SET status = 'cancelled', updated_at = now() WHERE user_email = %s"
-        return _upsert(sql, (user_email,))
+        ok = _upsert(sql, (user_email,))
+    invalidate_entitlement(email=user_email)
+    return ok
+
+_SQL_USER_SUBS = """
+    SELECT id, user_email, sku, platform, status, created_at, updated_at
+      FROM subscriptions
+     WHERE user_email = %s
+"""
+# ฟังก์ชัน effective_agents() สร้างใน SCHEMA_DDL (ขยาย 'all' ให้ฝั่ง DB แล้ว)
+_SQL_EFFECTIVE_AGENTS = "SELECT sku FROM effective_agents(%s);"
+# fallback เมื่อ effective_agents() ยังไม่มี (migration ล้ม/ไม่มีสิทธิ์ CREATE FUNCTION): ขยาย 'all' ฝั่ง Python
+_SQL_ACTIVE_SKUS = "SELECT sku FROM subscriptions WHERE user_email = %s AND status = 'active';"
+_HAS_EFFECTIVE_AGENTS = True
+
+def _expand_agents(active_skus) -> tuple:
+    """กติกาเดียวกับ effective_agents(): มี 'all' ที่ active → agent ครบ _ALL_AGENTS"""
+    active = tuple(active_skus)
+    return _ALL_AGENTS if "all" in active else active
+
+def _no_effective_agents_fn():
+    global _HAS_EFFECTIVE_AGENTS
+    if _HAS_EFFECTIVE_AGENTS:
+        _HAS_EFFECTIVE_AGENTS = False
+        log.warning("effective_agents() missing in DB (migration not applied); expanding 'all' in Python.")
+
+def _agents_key(user_email: str):
+    # normalize แบบเดียวกับ invalidate_entitlement → email ตัวพิมพ์ใหญ่/เล็กปนกันก็ถูกล้างเมื่อมีการเขียน
+    return ("agents", (user_email or "").lower().strip())
 
 def fetch_subscriptions(user_email: str):
     """
     Return all subscriptions for a user.
     """
-    sql = "SELECT * FROM subscriptions WHERE user_email = %s"
     try:
         with _connect() as conn, conn.cursor() as cur:
-            cur.execute(sql, (user_email,))
+            cur.execute(_SQL_USER_SUBS, (user_email,))
             return cur.fetchall()
-    except Exception as ex:
-        print(f"DB error: {ex}")
+    except Exception:
+        log.exception("DB error")
         return []
 
 def fetch_effective_agents(user_email: str):
     """
     Return active agent entitlements for a user.
     If sku = 'all', return all 33 agents.
+    (cache ENT_TTL วินาที — ไม่ cache กรณี DB error)
     """
-    sql = """
-        SELECT sku, platform, status
-          FROM subscriptions
-         WHERE user_email = %s
-           AND status = 'active';
-    """
+    key = _agents_key(user_email)
+    hit = _ent_cache_get(key)
+    if hit is not _MISS:
+        return list(hit)
     try:
-        with _connect() as conn, conn.cursor() as cur:
-            cur.execute(sql, (user_email,))
-            rows = cur.fetchall()
-
-            # If permanent "all" entitlement is found, return all agents
-            for row in rows:
-                if row["sku"] == "all":
-                    return [
-                        "budget_standard", "budget_plus", "budget_premium",
-                        "capex_standard", "capex_plus", "capex_premium",
-                        "cost_standard", "cost_plus", "cost_premium",
-                        "decision_standard", "decision_plus", "decision_premium",
-                        "enterprise_cf", "project_cf", "single_cf",
-                        "forecast_standard", "forecast_plus", "forecast_premium",
-                        "fx_standard", "fx_plus", "fx_premium",
-                        "margin_standard", "margin_plus", "margin_premium",
-                        "report_standard", "report_plus", "report_premium",
-                        "revenue_standard", "revenue_intermediate", "revenue_advance",
-                        "variance_standard", "variance_plus", "variance_premium",
-                    ]
-            # Otherwise return only entitled agents
-            return [row["sku"] for row in rows if row["sku"] != "all"]
-    except Exception as ex:
-        print(f"DB error: {ex}")
+        # ใช้แค่คอลัมน์ sku → scalar_row ได้ list ของ str ตรง ๆ ไม่ต้องสร้าง dict ทีละแถว
+        with _connect() as conn, conn.cursor(row_factory=scalar_row) as cur:
+            # If permanent "all" entitlement is found, DB returns all agents
+            # Otherwise only entitled agents
+            agents = None
+            if _HAS_EFFECTIVE_AGENTS:
+                try:
+                    cur.execute(_SQL_EFFECTIVE_AGENTS, (user_email,))
+                    agents = tuple(cur.fetchall())
+                except psycopg.errors.UndefinedFunction:
+                    _no_effective_agents_fn()
+            if agents is None:
+                cur.execute(_SQL_ACTIVE_SKUS, (user_email,))
+                agents = _expand_agents(cur.fetchall())
+            _ent_cache_set(key, agents)
+            return list(agents)
+    except Exception:
+        log.exception("DB error")
+        return []
+
+# --- async siblings (route async ใช้ pool แบบ async ตรง ๆ ไม่ต้องยึด thread ใน threadpool) ---
+async def afetch_subscriptions(user_email: str):
+    """async sibling ของ fetch_subscriptions"""
+    try:
+        pool = await _get_apool()
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(_SQL_USER_SUBS, (user_email,))
+                return await cur.fetchall()
+    except Exception:
+        log.exception("DB error")
+        return []
+
+async def afetch_effective_agents(user_email: str):
+    """async sibling ของ fetch_effective_agents (ใช้ cache ชุดเดียวกัน)"""
+    key = _agents_key(user_email)
+    hit = _ent_cache_get(key)
+    if hit is not _MISS:
+        return list(hit)
+    try:
+        pool = await _get_apool()
+        async with pool.connection() as conn:
+            async with conn.cursor(row_factory=scalar_row) as cur:
+                agents = None
+                if _HAS_EFFECTIVE_AGENTS:
+                    try:
+                        await cur.execute(_SQL_EFFECTIVE_AGENTS, (user_email,))
+                        agents = tuple(await cur.fetchall())
+                    except psycopg.errors.UndefinedFunction:
+                        _no_effective_agents_fn()
+                if agents is None:
+                    await cur.execute(_SQL_ACTIVE_SKUS, (user_email,))
+                    agents = _expand_agents(await cur.fetchall())
+        _ent_cache_set(key, agents)
+        return list(agents)
+    except Exception:
+        log.exception("DB error")
         return []
 
+def fetch_user_bundle(user_email: str):
+    """
+    ดึง subscriptions ทั้งหมด + effective agents ของผู้ใช้ในครั้งเดียว
+    (SELECT เดียว อ่านแถวของผู้ใช้รอบเดียว แล้วคำนวณ agents จากแถวเดียวกันใน Python
+     ตามกติกาเดียวกับ effective_agents(): มี 'all' ที่ active → agent ครบ _ALL_AGENTS)
+    RETURN: { "subscriptions": [...], "agents": [...] }
+    """
+    key = _agents_key(user_email)
+    try:
+        subs = _fetchall(_SQL_USER_SUBS, (user_email,))
+    except Exception:
+        log.exception("DB error fetch_user_bundle")
+        return {"subscriptions": [], "agents": []}
+    agents = _expand_agents(r["sku"] for r in subs if r["status"] == "active")
+    _ent_cache_set(key, agents)
+    return {"subscriptions": subs, "agents": list(agents)}
+
 # ---------- Enterprise helpers ----------
 def fetch_enterprise_licenses_for_domain(domain: str):
     """
@@ -314,10 +957,13 @@ def fetch_enterprise_licenses_for_domain(domain: str):
         with _connect() as conn, conn.cursor() as cur:
             cur.execute(sql, (d,))
             return cur.fetchall()
-    except Exception as ex:
-        print(f"DB error: {ex}")
+    except Exception:
+        log.exception("DB error")
         return []
 
+# ส่งเป็น array พารามิเตอร์เดียว → ข้อความ SQL คงที่ ใช้ prepared statement ซ้ำได้
+_EN_SKUS = list(_TIER_FROM_SKU)
+
 def get_active_enterprise_license_for_domain(domain: str):
     """
     คืน license enterprise ล่าสุดของโดเมน (PRIMARY: enterprise_licenses)
@@ -329,7 +975,13 @@ def get_active_enterprise_license_for_domain(domain: str):
     if not d:
         return None
 
+    key = ("domain", d)
+    hit = _ent_cache_get(key)
+    if hit is not _MISS:
+        return dict(hit) if hit else hit
+
     # 1) ดูจาก enterprise_licenses ก่อน
+    primary_ok = False
     sql1 = """
         SELECT sku, tier_code, active, activated_at
           FROM enterprise_licenses
@@ -341,8 +993,9 @@ def get_active_enterprise_license_for_domain(domain: str):
         with _connect() as conn, conn.cursor() as cur:
             cur.execute(sql1, (d,))
             row = cur.fetchone()
+            primary_ok = True
             if row:
-                return {
+                lic = {
                     "sku": row["sku"],
                     "platform": "Copilot",
                     "status": "active" if row.get("active") else "inactive",
@@ -350,78 +1003,158 @@ def get_active_enterprise_license_for_domain(domain: str):
                     "created_at": row.get("activated_at"),
                     "tier_code": row.get("tier_code"),
                 }
-    except Exception as ex:
-        print(f"DB error: {ex}")
+                _ent_cache_set(key, lic)
+                return dict(lic)
+    except Exception:
+        log.exception("DB error")
 
-    # 2) fallback: subscriptions (รองรับข้อมูลเก่า)
+    # 2) fallback: subscriptions (รองรับข้อมูลเก่า) — expression ตรงกับ subscriptions_email_domain_expr_idx
     sql2 = """
         SELECT sku, platform, status, user_email, created_at
           FROM subscriptions
          WHERE status = 'active'
-           AND sku IN ('en_standard','en_professional','en_unlimited')
-           AND lower(split_part(user_email,'@',2)) = lower(%s)
+           AND sku = ANY(%s::text[])
+           AND lower(split_part(user_email, '@', 2)) = %s
          ORDER BY created_at DESC
          LIMIT 1
     """
     try:
         with _connect() as conn, conn.cursor() as cur:
-            cur.execute(sql2, (d,))
-            return cur.fetchone()
-    except Exception as ex:
-        print(f"DB error: {ex}")
+            cur.execute(sql2, (_EN_SKUS, d))
+            row = cur.fetchone()
+            if primary_ok:
+                _ent_cache_set(key, row)
+            return dict(row) if row else row
+    except Exception:
+        log.exception("DB error")
         return None
 
 # ---------- Trial Users ----------
+_TZ_TH = ZoneInfo("Asia/Bangkok")
+
 def get_trial_users_by_day(day_offset: int = 0):
     """
     Return list of trial users whose created_at falls on Thailand's (Asia/Bangkok) date
     exactly `day_offset` days ago (0=today TH, 1=yesterday TH, etc.).
     """
+    # คำนวณช่วง [00:00, 00:00 วันถัดไป) ของวันไทยใน Python แล้วเทียบ created_at ตรง ๆ
+    # (ไม่แปลง timezone ทีละแถว → ใช้ index subscriptions_trial_created_idx ได้)
+    day_th = (datetime.now(_TZ_TH) - timedelta(days=day_offset)).date()
+    lo = datetime.combine(day_th, time.min, _TZ_TH)
+    hi = lo + timedelta(days=1)
     sql = """
         SELECT user_email, created_at, platform
           FROM subscriptions
          WHERE sku = 'trial'
            AND status = 'active'
-           AND (created_at AT TIME ZONE 'Asia/Bangkok')::date =
-               (now() AT TIME ZONE 'Asia/Bangkok')::date - %s::int;
+           AND created_at >= %s
+           AND created_at <  %s;
     """
     try:
         with _connect() as conn, conn.cursor() as cur:
-            cur.execute(sql, (day_offset,))
+            cur.execute(sql, (lo, hi))
             return cur.fetchall()
     except Exception:
+        log.exception("DB error get_trial_users_by_day")
         return []
 
-def ensure_permanent_admin_user():
+_SQL_TRIAL_BY_OFFSETS = """
+    SELECT d.day_offset, s.user_email, s.created_at, s.platform
+      FROM unnest(%s::int[], %s::timestamptz[], %s::timestamptz[]) AS d(day_offset, lo, hi)
+      JOIN subscriptions s
+        ON s.created_at >= d.lo AND s.created_at < d.hi
+     WHERE s.sku = 'trial'
+       AND s.status = 'active'
+     ORDER BY d.day_offset;
+"""
+
+def _trial_offset_params(offsets: list[int]):
+    today_th = datetime.now(_TZ_TH).date()
+    los = [datetime.combine(today_th - timedelta(days=o), time.min, _TZ_TH) for o in offsets]
+    his = [lo + timedelta(days=1) for lo in los]
+    return offsets, los, his
+
+def get_trial_users_for_offsets(day_offsets) -> dict[int, list]:
+    """
+    เหมือน get_trial_users_by_day แต่ดึงหลายวันใน query เดียว (เช่น Day 1/10/23 ของงานส่งอีเมล)
+    ส่งช่วงเวลาของแต่ละวันไทยเป็น array → DB ทำ index range scan ทีละช่วง (ไม่สแกนวันที่อยู่ระหว่างกลาง)
+    RETURN: { day_offset: [ {user_email, created_at, platform}, ... ] } — มีทุก offset ที่ขอ (ไม่มีผู้ใช้ = [])
+    """
+    offsets = sorted(set(int(o) for o in day_offsets))
+    out: dict[int, list] = {o: [] for o in offsets}
+    if not offsets:
+        return out
+    try:
+        rows = _fetchall(_SQL_TRIAL_BY_OFFSETS, _trial_offset_params(offsets))
+    except Exception:
+        log.exception("DB error get_trial_users_for_offsets")
+        return {}
+    for row in rows:
+        out[row.pop("day_offset")].append(row)
+    return out
+
+# ผู้ใช้ admin ถาวร: สิทธิ์ 'all' ครบทุก platform (id = 'perm-<platform>-all')
+ADMIN_EMAIL = "thanyaaura@email.com"
+ADMIN_PLATFORMS: tuple[str, ...] = ("GPT", "Gemini", "Copilot")
+
+# ส่ง platform เป็น array พารามิเตอร์เดียว → SQL คงที่ไม่ว่ากี่ platform (เพิ่ม platform ใหม่ไม่ต้องแก้ SQL)
+_SQL_ADMIN_MERGE = """
+    MERGE INTO subscriptions AS s
+    USING (
+        SELECT 'perm-' || lower(p) || '-all' AS id, %(email)s::text AS user_email,
+               'all' AS sku, p AS platform, 'active' AS status
+          FROM unnest(%(platforms)s::text[]) AS p
+    ) AS v
+    ON s.id = v.id
+    WHEN MATCHED AND (s.status IS DISTINCT FROM 'active' OR s.platform IS DISTINCT FROM v.platform) THEN
+        UPDATE SET platform = v.platform, status = 'active', updated_at = now()
+    WHEN NOT MATCHED THEN
+        INSERT (id, user_email, sku, platform, status, created_at, updated_at)
+        VALUES (v.id, v.user_email, v.sku, v.platform, v.status, now(), now());
+"""
+
+_SQL_ADMIN_UPSERT = """
+    INSERT INTO subscriptions (id, user_email, sku, platform, status, created_at, updated_at)
+    SELECT 'perm-' || lower(p) || '-all', %(email)s, 'all', p, 'active', now(), now()
+      FROM unnest(%(platforms)s::text[]) AS p
+    ON CONFLICT (id)
+    DO UPDATE SET platform   = EXCLUDED.platform,
+                  status     = 'active',
+                  updated_at = now();
+"""
+
+_ADMIN_ENSURED = False
+
+def ensure_permanent_admin_user(platforms=None):
     """
     Ensure thanyaaura@email.com always has permanent 'all' subscriptions
-    across GPT, Gemini, and Copilot.
+    across GPT, Gemini, and Copilot (ADMIN_PLATFORMS).
+    ส่ง platforms เองได้ (เช่น backfill platform ใหม่) — กรณีนี้รันทุกครั้ง ไม่ใช้ผลที่จำไว้
     (และ ensure โครงสร้างตาราง thin quota)
     """
-    sql = """
-        INSERT INTO subscriptions (id, user_email, sku, platform, status, created_at, updated_at)
-        VALUES
-            ('perm-gpt-all', 'thanyaaura@email.com', 'all', 'GPT', 'active', now(), now()),
-            ('perm-gemini-all', 'thanyaaura@email.com', 'all', 'Gemini', 'active', now(), now()),
-            ('perm-copilot-all', 'thanyaaura@email.com', 'all', 'Copilot', 'active', now(), now())
-        ON CONFLICT (id)
-        DO UPDATE SET platform   = EXCLUDED.platform,
-                      status     = 'active',
-                      updated_at = now();
-    """
-    try:
-        with _connect() as conn, conn.cursor() as cur:
-            cur.execute(sql)
-            conn.commit()
-            _ensure_quota_schema()
-            print("✅ Permanent admin user ensured in DB; quota schema ensured")
+    global _ADMIN_ENSURED
+    if platforms is None:
+        if _ADMIN_ENSURED:
             return True
-    except Exception as ex:
-        print(f"DB error ensuring permanent admin user: {ex}")
+        platforms = ADMIN_PLATFORMS
+    params = {"email": ADMIN_EMAIL, "platforms": list(platforms)}
+    try:
+        # autocommit: คำสั่งเดียว = 1 message (ไม่ต้อง BEGIN/COMMIT)
+        with _connect() as conn:
+            # PG15+: MERGE แก้เฉพาะแถวที่เปลี่ยนจริง (บูตซ้ำแล้วข้อมูลเหมือนเดิม = ไม่เขียน WAL / ไม่ lock แถว)
+            conn.execute(_SQL_ADMIN_MERGE if conn.info.server_version >= 150000 else _SQL_ADMIN_UPSERT, params)
+        invalidate_entitlement(email=ADMIN_EMAIL)
+        migrate()
+        if platforms is ADMIN_PLATFORMS:
+            _ADMIN_ENSURED = True
+        log.info("Permanent admin user ensured in DB; quota schema ensured")
+        return True
+    except Exception:
+        log.exception("DB error ensuring permanent admin user")
         try:
-            _ensure_quota_schema()
-        except Exception as ex2:
-            print(f"DB error ensuring quota schema: {ex2}")
+            migrate()
+        except Exception:
+            log.exception("DB error ensuring quota schema")
         return False
 
 # ======================================================================
@@ -429,60 +1162,95 @@ def ensure_permanent_admin_user():
 # ======================================================================
 
 # --- Tenant & API key management ---
+# SQL ของ tenant/quota เป็นค่าคงที่ระดับโมดูล: สร้างครั้งเดียวตอน import (ไม่ format f-string ใหม่ทุกครั้งที่เรียก)
+# ข้อความ SQL เดิมทุกครั้ง → psycopg จับคู่ prepared statement ที่ cache ไว้บน connection ได้ทันที
+_SQL_INSERT_TENANT = f"INSERT INTO {TBL_TENANTS}(name, status) VALUES (%s,'active') RETURNING id;"
+
+_SQL_TENANT_KEY_UPSERT = f"""
+    INSERT INTO {TBL_API_KEYS}(tenant_id, key_hash, active)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (key_hash) DO UPDATE SET
+        tenant_id = EXCLUDED.tenant_id,
+        active = EXCLUDED.active;
+"""
+
+_SQL_ROTATE_API_KEY = f"""
+    INSERT INTO {TBL_API_KEYS}(tenant_id, key_hash, active)
+    VALUES (%s,%s,%s)
+    ON CONFLICT (key_hash) DO UPDATE SET
+        tenant_id = EXCLUDED.tenant_id,
+        active = EXCLUDED.active,
+        expires_at = NULL;
+"""
+
 def create_or_update_tenant_with_key(name: str, api_key_hash: str, active: bool = True) -> int:
     """
     สร้าง/แก้ไข tenant + api key (hash แล้ว) — คืน tenant_id
     หมายเหตุ: api_key_hash = sha256(plain).hexdigest() (ทำในแอปก่อนส่งมา)
     """
-    _ensure_quota_schema()
-    with _connect() as conn, conn.cursor() as cur:
-        cur.execute(f"INSERT INTO {TBL_TENANTS}(name, status) VALUES (%s,'active') RETURNING id;", (name,))
+    with _connect() as conn, conn.transaction(), conn.cursor() as cur:
+        cur.execute(_SQL_INSERT_TENANT, (name,))
         tid = cur.fetchone()["id"]
-        cur.execute(f"""
-            INSERT INTO {TBL_API_KEYS}(tenant_id, key_hash, active)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (key_hash) DO UPDATE SET
-                tenant_id = EXCLUDED.tenant_id,
-                active = EXCLUDED.active;
-        """, (tid, api_key_hash, active))
-        conn.commit()
-        return tid
+        cur.execute(_SQL_TENANT_KEY_UPSERT, (tid, api_key_hash, active))
+    _tenant_cache_pop(api_key_hash)
+    return tid
 
 def add_or_rotate_api_key(tenant_id: int, api_key_hash: str, active: bool = True):
-    _ensure_quota_schema()
-    return _upsert(
-        f"""
-        INSERT INTO {TBL_API_KEYS}(tenant_id, key_hash, active)
-        VALUES (%s,%s,%s)
-        ON CONFLICT (key_hash) DO UPDATE SET
-            tenant_id = EXCLUDED.tenant_id,
-            active = EXCLUDED.active,
-            expires_at = NULL;
-        """,
-        (tenant_id, api_key_hash, active),
-    )
+    ok = _upsert(_SQL_ROTATE_API_KEY, (tenant_id, api_key_hash, active))
+    _tenant_cache_pop(api_key_hash)
+    return ok
+
+# tenant ต่อ api key แทบไม่เปลี่ยน → cache สั้น ๆ (เฉพาะที่พบ; ไม่ cache None เพื่อให้ key ใหม่ใช้ได้ทันที)
+TENANT_CACHE_TTL = int(os.getenv("TENANT_CACHE_TTL", "60"))
+_TENANT_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=TENANT_CACHE_TTL)
+_TENANT_LOCK = threading.RLock()
+
+def _tenant_cache_pop(key_hash: str):
+    with _TENANT_LOCK:
+        _TENANT_CACHE.pop(key_hash, None)
+
+_SQL_TENANT_BY_KEY = f"""
+    SELECT t.id, t.name, t.status, t.created_at
+      FROM {TBL_API_KEYS} k
+      JOIN {TBL_TENANTS} t ON t.id = k.tenant_id
+     WHERE k.key_hash = %s
+       AND k.active IS TRUE
+       AND (k.expires_at IS NULL OR k.expires_at > now())
+     LIMIT 1;
+"""
 
 def get_tenant_by_api_key_hash(key_hash: str):
     """
     RETURN: { id, name, status, created_at } | None
+    (cache TENANT_CACHE_TTL วินาที; ล้างเมื่อ add_or_rotate_api_key / create_or_update_tenant_with_key)
     """
-    _ensure_quota_schema()
-    sql = f"""
-        SELECT t.id, t.name, t.status, t.created_at
-          FROM {TBL_API_KEYS} k
-          JOIN {TBL_TENANTS} t ON t.id = k.tenant_id
-         WHERE k.key_hash = %s
-           AND k.active IS TRUE
-           AND (k.expires_at IS NULL OR k.expires_at > now())
-         LIMIT 1;
-    """
+    with _TENANT_LOCK:
+        hit = _TENANT_CACHE.get(key_hash)
+    if hit is not None:
+        return dict(hit)
     try:
-        return _fetchone(sql, (key_hash,))
-    except Exception as ex:
-        print(f"DB error get_tenant_by_api_key_hash: {ex}")
+        row = _fetchone(_SQL_TENANT_BY_KEY, (key_hash,))
+    except Exception:
+        log.exception("DB error get_tenant_by_api_key_hash")
         return None
+    if row:
+        with _TENANT_LOCK:
+            _TENANT_CACHE[key_hash] = row
+        return dict(row)
+    return row
 
 # --- Subscription (ENT_STANDARD / ENT_PLUS / ENT_PRO) ---
+_SQL_SET_TENANT_SUB = f"""
+    INSERT INTO {TBL_SUBS_ENT}(tenant_id, plan_code, monthly_quota, extra_quota_balance, renew_day, status, created_at, updated_at)
+    VALUES (%s, %s, %s, 0, %s, %s, now(), now())
+    ON CONFLICT (tenant_id) DO UPDATE SET
+        plan_code = EXCLUDED.plan_code,
+        monthly_quota = EXCLUDED.monthly_quota,
+        renew_day = EXCLUDED.renew_day,
+        status = EXCLUDED.status,
+        updated_at = now();
+"""
+
 def set_tenant_subscription(tenant_id: int, plan_code: str, monthly_quota: int, renew_day: int = 1, status: str = "active"):
     """
     กำหนด/อัปเดตแผน Thin ของ tenant
@@ -490,107 +1258,197 @@ def set_tenant_subscription(tenant_id: int, plan_code: str, monthly_quota: int,
     monthly_quota: จำนวน calls/เดือน
     renew_day: วันตัดรอบ (1..28) — มักตั้งตามวันชำระเงินบิลแรก
     """
-    _ensure_quota_schema()
-    sql = f"""
-        INSERT INTO {TBL_SUBS_ENT}(tenant_id, plan_code, monthly_quota, extra_quota_balance, renew_day, status, created_at, updated_at)
-        VALUES (%s, %s, %s, 0, %s, %s, now(), now())
-        ON CONFLICT (tenant_id) DO UPDATE SET
-            plan_code = EXCLUDED.plan_code,
-            monthly_quota = EXCLUDED.monthly_quota,
-            renew_day = EXCLUDED.renew_day,
-            status = EXCLUDED.status,
-            updated_at = now();
-    """
-    return _upsert(sql, (tenant_id, plan_code, monthly_quota, renew_day, status))
+    return _upsert(_SQL_SET_TENANT_SUB, (tenant_id, plan_code, monthly_quota, renew_day, status))
+
+_SQL_ADD_QUOTA_ADDON = f"""
+    UPDATE {TBL_SUBS_ENT}
+       SET extra_quota_balance = COALESCE(extra_quota_balance,0) + %s,
+           updated_at = now()
+     WHERE tenant_id = %s;
+"""
 
 def add_quota_addon(tenant_id: int, addon_calls: int):
     """
     เติมโควตาเพิ่มเข้าบัญชี tenant (เช่น ซื้อ addon_1k x 3 = 3,000 calls)
     """
-    _ensure_quota_schema()
-    sql = f"""
-        UPDATE {TBL_SUBS_ENT}
-           SET extra_quota_balance = COALESCE(extra_quota_balance,0) + %s,
-               updated_at = now()
-         WHERE tenant_id = %s;
-    """
-    return _upsert(sql, (addon_calls, tenant_id))
+    return _upsert(_SQL_ADD_QUOTA_ADDON, (addon_calls, tenant_id))
+
+_SQL_SUB_BY_TENANT = f"""
+    SELECT tenant_id, plan_code, monthly_quota, extra_quota_balance, renew_day, status
+      FROM {TBL_SUBS_ENT}
+     WHERE tenant_id = %s AND status = 'active'
+     LIMIT 1;
+"""
 
 def get_subscription_by_tenant_id(tenant_id: int):
     """
     RETURN: { tenant_id, plan_code, monthly_quota, extra_quota_balance, renew_day, status } | None
     """
-    _ensure_quota_schema()
-    sql = f"SELECT * FROM {TBL_SUBS_ENT} WHERE tenant_id = %s AND status = 'active' LIMIT 1;"
     try:
-        return _fetchone(sql, (tenant_id,))
-    except Exception as ex:
-        print(f"DB error get_subscription_by_tenant_id: {ex}")
+        return _fetchone(_SQL_SUB_BY_TENANT, (tenant_id,))
+    except Exception:
+        log.exception("DB error get_subscription_by_tenant_id")
         return None
 
 # --- Usage & Idempotency ---
-def ensure_usage_bucket(tenant_id: int, yyyymm: str):
-    _ensure_quota_schema()
-    sql = f"""
-        INSERT INTO {TBL_USAGE}(tenant_id, period_yyyymm, calls_used)
-        VALUES (%s, %s, 0)
-        ON CONFLICT (tenant_id, period_yyyymm) DO NOTHING;
-    """
-    return _upsert(sql, (tenant_id, yyyymm))
+# bucket รายเดือนคำนวณฝั่ง DB ('YYYY-MM' ตามเวลา UTC เหมือนเดิม) — ทุก worker ได้ค่าเดียวกันไม่ขึ้นกับ TZ ของเครื่อง
+# อย่าเปลี่ยน timezone โดยไม่ย้ายข้อมูล: ขอบเดือนโควตาจะเลื่อน และ usage ช่วงรอยต่อจะไปตก bucket อื่น
+# helper ด้านล่างรับ yyyymm=None (ค่าเริ่มต้น) = เดือนปัจจุบันตามนาฬิกา DB; ส่งค่ามาเองได้ถ้ามี bucket เฉพาะ
+# cast เป็น char(7) ให้ตรงชนิดคอลัมน์ → เทียบกับ PRIMARY KEY ได้ตรง ๆ (ไม่ต้อง cast คอลัมน์)
+_SQL_BUCKET = "COALESCE({p}, to_char(now() AT TIME ZONE 'UTC', 'YYYY-MM'))::char(7)"
+_BUCKET = _SQL_BUCKET.format(p="%s")
 
-def get_calls_used(tenant_id: int, yyyymm: str) -> int:
-    _ensure_quota_schema()
-    sql = f"SELECT calls_used FROM {TBL_USAGE} WHERE tenant_id = %s AND period_yyyymm = %s;"
+_SQL_ENSURE_BUCKET = f"""
+    INSERT INTO {TBL_USAGE}(tenant_id, period_yyyymm, calls_used)
+    VALUES (%s, {_BUCKET}, 0)
+    ON CONFLICT (tenant_id, period_yyyymm) DO NOTHING;
+"""
+
+def ensure_usage_bucket(tenant_id: int, yyyymm: str | None = None):
+    return _upsert(_SQL_ENSURE_BUCKET, (tenant_id, yyyymm))
+
+_SQL_GET_CALLS_USED = f"SELECT calls_used FROM {TBL_USAGE} WHERE tenant_id = %s AND period_yyyymm = {_BUCKET};"
+
+def get_calls_used(tenant_id: int, yyyymm: str | None = None) -> int:
     try:
-        row = _fetchone(sql, (tenant_id, yyyymm))
-        return int(row["calls_used"]) if row and row.get("calls_used") is not None else 0
-    except Exception as ex:
-        print(f"DB error get_calls_used: {ex}")
+        used = _fetchval(_SQL_GET_CALLS_USED, (tenant_id, yyyymm))
+        return int(used) if used is not None else 0
+    except Exception:
+        log.exception("DB error get_calls_used")
         return 0
 
-def increment_calls_used(tenant_id: int, yyyymm: str, amount: int) -> bool:
-    _ensure_quota_schema()
+def increment_calls_used(tenant_id: int, yyyymm: str | None = None, amount: int = 1) -> bool:
+    """
+    เพิ่มตัวนับการใช้งาน (สร้าง bucket ให้เองถ้ายังไม่มี) — upsert คำสั่งเดียว
+    ถ้าต้องการค่าหลังเพิ่ม (ไม่ต้อง SELECT ซ้ำ) ให้ใช้ add_calls_used
+    """
+    return add_calls_used(tenant_id, yyyymm, amount) is not None
+
+_SQL_INCR_USAGE = f"""
+    INSERT INTO {TBL_USAGE}(tenant_id, period_yyyymm, calls_used)
+    VALUES (%s, {_BUCKET}, %s)
+    ON CONFLICT (tenant_id, period_yyyymm) DO UPDATE SET
+        calls_used = {TBL_USAGE}.calls_used + EXCLUDED.calls_used
+    RETURNING calls_used;
+"""
+
+def add_calls_used(tenant_id: int, yyyymm: str | None = None, amount: int = 1) -> int | None:
+    """
+    เหมือน increment_calls_used แต่คืนค่า calls_used หลังเพิ่ม (None = DB error)
+    """
     try:
-        with _connect() as conn, conn.cursor() as cur:
-            cur.execute(f"""
-                UPDATE {TBL_USAGE}
-                   SET calls_used = calls_used + %s
-                 WHERE tenant_id = %s AND period_yyyymm = %s;
-            """, (amount, tenant_id, yyyymm))
-            if cur.rowcount == 0:
-                # fallback: create bucket then retry once
-                cur.execute(f"""
-                    INSERT INTO {TBL_USAGE}(tenant_id, period_yyyymm, calls_used)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (tenant_id, period_yyyymm) DO UPDATE SET
-                        calls_used = {TBL_USAGE}.calls_used + EXCLUDED.calls_used;
-                """, (tenant_id, yyyymm, amount))
-            conn.commit()
-            return True
-    except Exception as ex:
-        print(f"DB error increment_calls_used: {ex}")
-        return False
+        return _fetchval(_SQL_INCR_USAGE, (tenant_id, yyyymm, amount))
+    except Exception:
+        log.exception("DB error increment_calls_used")
+        return None
+
+_SQL_DEBIT_QUOTA = f"""
+    INSERT INTO {TBL_USAGE} AS u (tenant_id, period_yyyymm, calls_used)
+    SELECT s.tenant_id, {_SQL_BUCKET.format(p="%(yyyymm)s")}, %(amount)s
+      FROM {TBL_SUBS_ENT} s
+     WHERE s.tenant_id = %(tenant_id)s AND s.status = 'active'
+       AND %(amount)s::int <= s.monthly_quota + s.extra_quota_balance
+    ON CONFLICT (tenant_id, period_yyyymm) DO UPDATE SET
+        calls_used = u.calls_used + EXCLUDED.calls_used
+     WHERE u.calls_used + EXCLUDED.calls_used <= (
+           SELECT s.monthly_quota + s.extra_quota_balance
+             FROM {TBL_SUBS_ENT} s
+            WHERE s.tenant_id = u.tenant_id AND s.status = 'active'
+     )
+    RETURNING u.calls_used;
+"""
+
+def debit_quota(tenant_id: int, yyyymm: str | None = None, amount: int = 1) -> int | None:
+    """
+    ตรวจโควตา + หักในคำสั่งเดียว (แทน ensure_usage_bucket → get_calls_used → เทียบใน Python → increment)
+    โควตา = monthly_quota + extra_quota_balance ของแผน active ใน TBL_SUBS_ENT
+    ไม่มีช่องว่างระหว่างอ่านกับเขียน: หลาย worker หัก tenant เดียวกันพร้อมกันก็ไม่เกินโควตา
+    RETURN: calls_used หลังหัก | None (โควตาไม่พอ / ไม่มีแผน active)
+    DB error → raise ให้ผู้เรียกตัดสินใจเอง (ไม่ปนกับกรณีโควตาไม่พอ)
+    """
+    return _fetchval(_SQL_DEBIT_QUOTA, {"tenant_id": tenant_id, "yyyymm": yyyymm, "amount": amount})
+
+_SQL_SEEN_IDEM = f"SELECT EXISTS (SELECT 1 FROM {TBL_IDEM} WHERE tenant_id = %s AND idem_key = %s);"
 
 def seen_idempotency(tenant_id: int, idem_key: str | None) -> bool:
     if not idem_key:
         return False
-    _ensure_quota_schema()
-    sql = f"SELECT 1 FROM {TBL_IDEM} WHERE tenant_id = %s AND idem_key = %s;"
     try:
-        row = _fetchone(sql, (tenant_id, idem_key))
-        return bool(row)
-    except Exception as ex:
-        print(f"DB error seen_idempotency: {ex}")
+        return bool(_fetchval(_SQL_SEEN_IDEM, (tenant_id, idem_key)))
+    except Exception:
+        log.exception("DB error seen_idempotency")
         return False
 
+_SQL_WRITE_IDEM = f"""
+    INSERT INTO {TBL_IDEM}(tenant_id, idem_key, created_at)
+    SELECT %s, %s, now()
+     WHERE NOT EXISTS (
+           SELECT 1 FROM {TBL_IDEM} WHERE tenant_id = %s AND idem_key = %s
+     );
+"""
+
 def write_idempotency(tenant_id: int, idem_key: str):
-    _ensure_quota_schema()
-    sql = f"""
+    """
+    บันทึก idempotency key (ถ้ามีอยู่แล้วถือว่าสำเร็จ)
+    กรองด้วย NOT EXISTS ก่อน insert: key ซ้ำ (client retry) จะไม่เกิด speculative insert / tuple lock
+    กรณีสองคำขอชนกันพร้อมกัน PRIMARY KEY ยังกันซ้ำให้ → UniqueViolation นับเป็นสำเร็จ
+    """
+    try:
+        _exec(_SQL_WRITE_IDEM, (tenant_id, idem_key, tenant_id, idem_key))
+        return True
+    except psycopg.errors.UniqueViolation:
+        return True
+    except Exception:
+        log.exception("DB error write_idempotency")
+        return False
+
+# --- Charge one call (idempotency + quota ในคำสั่งเดียว) ---
+_SQL_CHARGE_CALL = f"""
+    WITH ins AS (
         INSERT INTO {TBL_IDEM}(tenant_id, idem_key, created_at)
-        VALUES (%s, %s, now())
-        ON CONFLICT (tenant_id, idem_key) DO NOTHING;
+        SELECT %(tenant_id)s, %(idem_key)s::text, now()
+         WHERE %(idem_key)s::text IS NOT NULL
+        ON CONFLICT (tenant_id, idem_key) DO NOTHING
+        RETURNING 1
+    ), bump AS (
+        INSERT INTO {TBL_USAGE}(tenant_id, period_yyyymm, calls_used)
+        SELECT %(tenant_id)s, {_SQL_BUCKET.format(p="%(yyyymm)s")}, %(amount)s
+         WHERE %(idem_key)s::text IS NULL OR EXISTS (SELECT 1 FROM ins)
+        ON CONFLICT (tenant_id, period_yyyymm) DO UPDATE SET
+            calls_used = {TBL_USAGE}.calls_used + EXCLUDED.calls_used
+         WHERE %(limit)s::int <= 0 OR {TBL_USAGE}.calls_used < %(limit)s::int
+        RETURNING calls_used
+    )
+    SELECT %(idem_key)s::text IS NULL OR EXISTS (SELECT 1 FROM ins) AS first_seen,
+           (SELECT calls_used FROM bump) AS calls_used;
+"""
+
+def charge_call(tenant_id: int, yyyymm: str | None, idem_key: str | None, limit: int, amount: int = 1):
     """
-    return _upsert(sql, (tenant_id, idem_key))
+    หักโควตา 1 call แบบ atomic ใน round-trip เดียว (แทน seen_idempotency + ensure_usage_bucket
+    + get_calls_used + increment_calls_used + write_idempotency)
+    - idem_key เคยใช้แล้ว      → first_seen=False, charged=False (ผ่านโดยไม่หักซ้ำ)
+    - โควตาเต็ม (limit > 0)    → first_seen=True,  charged=False (rollback ไม่บันทึก idem key)
+    - ปกติ                      → first_seen=True,  charged=True
+    yyyymm=None → bucket เดือนปัจจุบัน (UTC) คำนวณใน DB
+    RETURN: { first_seen, charged, calls_used }
+    DB error → raise (limits._db_safe_call log แล้ว degrade/บล็อกตาม LIMITS_DEGRADE_OK)
+    """
+    params = {
+        "tenant_id": tenant_id,
+        "idem_key": idem_key or None,
+        "yyyymm": yyyymm,
+        "amount": amount,
+        "limit": limit,
+    }
+    with _connect() as conn, conn.transaction():
+        row = conn.execute(_SQL_CHARGE_CALL, params).fetchone()
+        first_seen = bool(row["first_seen"])
+        charged = row["calls_used"] is not None
+        if first_seen and not charged:
+            # โควตาเต็ม: อย่าเก็บ idem key ไว้ (retry ครั้งหน้าต้องถูกตรวจโควตาใหม่)
+            raise psycopg.Rollback()
+    return {"first_seen": first_seen, "charged": charged, "calls_used": row["calls_used"]}
 
 # ======================================================================
 # __all__
@@ -598,16 +1456,35 @@ def write_idempotency(tenant_id: int, idem_key: str):
 __all__ = [
     # health & legacy
     "ping_db",
+    "close_pool",
+    "aping_db",
+    "readiness_db",
+    "aclose_pool",
     "upsert_subscription_and_entitlement",
     "upsert_tier_subscription",
     "upsert_enterprise_license",
+    "bulk_upsert_subscriptions",
+    "upsert_subscriptions_bulk",
+    "bulk_grant_all_agents",
+    "aupsert_subscription_and_entitlement",
+    "aupsert_tier_subscription",
+    "aupsert_enterprise_license",
+    "upsert_many",
+    "aupsert_many",
     "cancel_subscription",
+    "drain_pending_deactivations",
+    "invalidate_entitlement",
     "fetch_subscriptions",
     "fetch_effective_agents",
+    "afetch_subscriptions",
+    "afetch_effective_agents",
+    "fetch_user_bundle",
     "fetch_enterprise_licenses_for_domain",
     "get_active_enterprise_license_for_domain",
     "get_trial_users_by_day",
+    "get_trial_users_for_offsets",
     "ensure_permanent_admin_user",
+    "migrate",
     # thin/quota
     "create_or_update_tenant_with_key",
     "add_or_rotate_api_key",
@@ -618,6 +1495,9 @@ __all__ = [
     "ensure_usage_bucket",
     "get_calls_used",
     "increment_calls_used",
+    "add_calls_used",
+    "debit_quota",
     "seen_idempotency",
     "write_idempotency",
+    "charge_call",
 ]
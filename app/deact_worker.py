@@ -0,0 +1,60 @@
+# app/deact_worker.py
+"""
+worker สำหรับคิว pending_deactivations (ใช้คู่กับ EN_DEACTIVATE_ASYNC=1)
+- LISTEN ช่อง db.DEACT_CHANNEL → ตื่นทันทีเมื่อ webhook เข้าคิว
+- ไม่มี NOTIFY ภายใน DEACT_POLL วินาทีก็ drain รอบหนึ่งอยู่ดี (กันพลาด notify ระหว่าง reconnect)
+รัน: python -m app.deact_worker
+"""
+import os
+import time
+import logging
+
+import psycopg
+
+from app import db
+
+def _env_log_level(default: str = "INFO") -> int:
+    """Normalize LOG_LEVEL env (e.g., 'info', 'INFO', '20') to a valid logging level."""
+    lvl = str(os.getenv("LOG_LEVEL", default)).strip()
+    if lvl.isdigit():
+        return int(lvl)
+    return getattr(logging, lvl.upper(), logging.INFO)
+
+logging.basicConfig(
+    level=_env_log_level(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+log = logging.getLogger("thanyaaura.deact_worker")
+
+DEACT_POLL = float(os.getenv("DEACT_POLL", "30"))
+RECONNECT_DELAY = float(os.getenv("DEACT_RECONNECT_DELAY", "5"))
+
+
+def _drain():
+    n = db.drain_pending_deactivations()
+    if n:
+        log.info("Drained %d pending deactivation(s).", n)
+
+
+def run_forever():
+    while True:
+        try:
+            # connection แยกจาก pool: LISTEN ผูกกับ session ต้องถือไว้ตลอด
+            with psycopg.connect(db._db_url(), autocommit=True) as conn:
+                conn.execute(f"LISTEN {db.DEACT_CHANNEL}")
+                log.info("Listening on %s", db.DEACT_CHANNEL)
+                while True:
+                    _drain()
+                    # รอ notify แรก (หรือหมดเวลา) แล้ววนกลับไป drain — notify ที่มาพร้อมกันรวมเป็นรอบเดียว
+                    for _ in conn.notifies(timeout=DEACT_POLL, stop_after=1):
+                        pass
+        except (KeyboardInterrupt, SystemExit):
+            log.info("Deactivation worker stopped.")
+            return
+        except Exception:
+            log.exception("Deactivation worker error; reconnecting in %.0fs", RECONNECT_DELAY)
+            time.sleep(RECONNECT_DELAY)
+
+
+if __name__ == "__main__":
+    run_forever()
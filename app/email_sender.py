@@ -1,14 +1,41 @@
 # app/email_sender.py
 import os
+import logging
 import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import unicodedata
+from functools import lru_cache
 from email.mime.text import MIMEText
 from email.header import Header
 from email.utils import formataddr
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+log = logging.getLogger("thanyaaura.gateway.email")
 
 # ---------------- Jinja env ----------------
-env = Environment(loader=FileSystemLoader("app/templates"))
+# auto_reload=False: template ที่ compile แล้วอยู่ใน cache ตลอด ไม่ต้อง stat ไฟล์ทุกครั้งที่ render
+# bytecode cache บนดิสก์: process ใหม่ (worker/scheduler/restart) โหลด code ที่ compile แล้ว ไม่ต้อง lex+parse ซ้ำ
+JINJA_CACHE_DIR = os.getenv("JINJA_CACHE_DIR", "/tmp/jinja_cache")
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+env = Environment(
+    loader=FileSystemLoader("app/templates"),
+    auto_reload=False,
+    cache_size=400,
+    bytecode_cache=FileSystemBytecodeCache(directory=JINJA_CACHE_DIR, pattern="%s.cache"),
+)
+
+# ตารางแทนที่อักขระ (สร้างครั้งเดียว) → translate สแกนสตริงรอบเดียวแทน replace ทีละตัว
+_CLEAN_TABLE = str.maketrans({
+    "\xa0": " ",
+    "–": "-",
+    "—": "-",
+    "“": '"',
+    "”": '"',
+    "’": "'",
+    "‘": "'",
+})
 
 def clean_text(value: str) -> str:
     """
@@ -16,19 +43,16 @@ def clean_text(value: str) -> str:
     """
     if not value:
         return ""
-    return (
-        value.replace("\xa0", " ")
-             .replace("–", "-")
-             .replace("—", "-")
-             .replace("“", '"')
-             .replace("”", '"')
-             .replace("’", "'")
-    )
+    # ASCII ล้วนไม่มีอักขระในตาราง → คืนค่าเดิมโดยไม่ต้อง translate
+    if value.isascii():
+        return value
+    return value.translate(_CLEAN_TABLE)
 
 env.filters["clean"] = clean_text
 
 # ---------------- Helpers ----------------
 NBSP = "\xa0"
+_NBSP_TABLE = str.maketrans({NBSP: " "})
 
 def _sanitize(text: str | None) -> str:
     """
@@ -36,7 +60,11 @@ def _sanitize(text: str | None) -> str:
     """
     if text is None:
         return ""
-    return unicodedata.normalize("NFKC", str(text)).replace(NBSP, " ")
+    s = str(text)
+    # ASCII ล้วน: NFKC ไม่เปลี่ยนอะไรและไม่มี NBSP → ข้ามการสแกนทั้งสตริง
+    if s.isascii():
+        return s
+    return unicodedata.normalize("NFKC", s).translate(_NBSP_TABLE)
 
 def _ascii_credential(raw: str | None, name_for_log: str) -> str:
     """
@@ -50,9 +78,10 @@ def _ascii_credential(raw: str | None, name_for_log: str) -> str:
     except UnicodeEncodeError:
         # Remove non-ASCII codepoints (e.g., NBSP, smart quotes)
         ascii_only = "".join(ch for ch in s if ord(ch) < 128)
-        print(
-            f"[email_warn] {name_for_log} contained non-ASCII characters and was sanitized. "
-            "Retype this value in your environment (avoid copy/paste)."
+        log.warning(
+            "%s contained non-ASCII characters and was sanitized. "
+            "Retype this value in your environment (avoid copy/paste).",
+            name_for_log,
         )
         return ascii_only
 
@@ -75,14 +104,170 @@ SMTP_PASS = _ascii_credential(os.getenv("SMTP_PASS") or "", "SMTP_PASS")
 FROM_EMAIL = _ascii_credential(os.getenv("FROM_EMAIL") or SMTP_USER or "no-reply@thanyaaura.com", "FROM_EMAIL")
 # Display name can be UTF-8
 FROM_NAME = _sanitize(os.getenv("FROM_NAME") or "Thanyaaura")
+# header From คงที่ทั้ง process → encode ครั้งเดียวตอน import
+_FROM_HEADER = formataddr((FROM_NAME if FROM_NAME.isascii() else str(Header(FROM_NAME, "utf-8")), FROM_EMAIL))
 
 DISABLE_EMAIL = _bool_env("DISABLE_EMAIL")
 
+# จำนวน SMTP connection ที่ส่งพร้อมกันใน send_bulk / send_trial_batch (ผู้ให้บริการส่วนใหญ่จำกัด connection พร้อมกัน)
+try:
+    EMAIL_WORKERS = max(1, int(_sanitize(os.getenv("EMAIL_WORKERS") or "4")))
+except ValueError:
+    EMAIL_WORKERS = 4
+
+# ---------------- SMTP connection (reused per thread) ----------------
+# เปิด TCP + STARTTLS + AUTH ครั้งเดียวต่อ thread แล้วส่งหลายฉบับบน connection เดิม
+# connection ที่เปิดอยู่ลงทะเบียนใน _open_slots → reaper ปิดตัวที่ว่างนาน (เช่นของ thread ใน threadpool ของ FastAPI
+# ที่ไม่มีใครเรียก close_smtp() ให้)
+_smtp_local = threading.local()
+_open_slots: set = set()
+_slots_lock = threading.Lock()
+_reaper_started = False
+
+# ส่งครบกี่ฉบับแล้วปิด/เปิด connection ใหม่ (ผู้ให้บริการหลายรายแนะนำไม่เกิน ~100 ฉบับต่อ connection)
+try:
+    SMTP_MAX_PER_CONN = max(1, int(_sanitize(os.getenv("SMTP_MAX_PER_CONN") or "100")))
+except ValueError:
+    SMTP_MAX_PER_CONN = 100
+
+# connection ว่างเกิน N วินาที: ไม่ใช้ซ้ำ (server มักตัด session ที่ idle) และ reaper ปิดทิ้ง
+try:
+    SMTP_IDLE_MAX = max(1.0, float(_sanitize(os.getenv("SMTP_IDLE_MAX") or "30")))
+except ValueError:
+    SMTP_IDLE_MAX = 30.0
+
+class _SmtpSlot:
+    """SMTP connection ของ thread หนึ่ง; lock กันไม่ให้ reaper ปิดระหว่างที่เจ้าของกำลังส่ง"""
+    __slots__ = ("server", "sent", "last_used", "lock")
+
+    def __init__(self):
+        self.server = None
+        self.sent = 0
+        self.last_used = 0.0
+        self.lock = threading.Lock()
+
+def _open_smtp() -> smtplib.SMTP:
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
+    try:
+        server.ehlo()
+        # TLS if supported
+        try:
+            server.starttls()
+            server.ehlo()
+        except smtplib.SMTPException:
+            pass
+        server.login(SMTP_USER, SMTP_PASS)  # Python encodes this as ASCII
+    except Exception:
+        server.close()
+        raise
+    return server
+
+def _slot() -> _SmtpSlot:
+    slot = getattr(_smtp_local, "slot", None)
+    if slot is None:
+        slot = _smtp_local.slot = _SmtpSlot()
+    return slot
+
+def _close_slot(slot: _SmtpSlot):
+    # เรียกขณะถือ slot.lock
+    server, slot.server = slot.server, None
+    with _slots_lock:
+        _open_slots.discard(slot)
+    if server is None:
+        return
+    try:
+        server.quit()
+    except Exception:
+        server.close()
+
+def _slot_server(slot: _SmtpSlot) -> smtplib.SMTP:
+    # เรียกขณะถือ slot.lock: คืน connection ที่พร้อมใช้ (ว่างนานเกิน SMTP_IDLE_MAX → เปิดใหม่)
+    if slot.server is not None and time.monotonic() - slot.last_used > SMTP_IDLE_MAX:
+        _close_slot(slot)
+    if slot.server is None:
+        slot.server = _open_smtp()
+        slot.sent = 0
+        slot.last_used = time.monotonic()
+        with _slots_lock:
+            _open_slots.add(slot)
+        _start_reaper()
+    return slot.server
+
+def close_smtp():
+    """ปิด SMTP connection ของ thread นี้ (เรียกตอนจบงานส่งอีเมลชุดหนึ่ง)"""
+    slot = _slot()
+    with slot.lock:
+        _close_slot(slot)
+
+def close_idle_smtp(max_idle: float | None = None):
+    """ปิด connection ของทุก thread ที่ว่างเกิน max_idle วินาที (ข้ามตัวที่กำลังส่งอยู่)"""
+    limit = SMTP_IDLE_MAX if max_idle is None else max_idle
+    now = time.monotonic()
+    with _slots_lock:
+        slots = list(_open_slots)
+    for slot in slots:
+        if not slot.lock.acquire(blocking=False):
+            continue
+        try:
+            if slot.server is not None and now - slot.last_used > limit:
+                _close_slot(slot)
+        finally:
+            slot.lock.release()
+
+def _reap_forever():
+    while True:
+        time.sleep(SMTP_IDLE_MAX)
+        try:
+            close_idle_smtp()
+        except Exception:
+            log.exception("SMTP idle reaper error")
+
+def _start_reaper():
+    global _reaper_started
+    with _slots_lock:
+        if _reaper_started:
+            return
+        _reaper_started = True
+    threading.Thread(target=_reap_forever, name="smtp-reaper", daemon=True).start()
+
+def _is_reconnectable(e: Exception) -> bool:
+    # server ตัด session (หลุด/idle timeout) หรือตอบ 421 "service not available, closing channel"
+    if isinstance(e, (smtplib.SMTPServerDisconnected, ConnectionError)):
+        return True
+    return isinstance(e, smtplib.SMTPResponseException) and e.smtp_code == 421
+
+def _sendmail(to_ascii: str, msg_str: str):
+    """
+    ส่งผ่าน connection ที่ cache ไว้; ถ้า server ตัดไปแล้ว (หลุด / 421) เปิดใหม่แล้วลองอีกครั้ง
+    """
+    slot = _slot()
+    with slot.lock:
+        try:
+            _slot_server(slot).sendmail(FROM_EMAIL, [to_ascii], msg_str)
+        except Exception as e:
+            if not _is_reconnectable(e):
+                raise
+            _close_slot(slot)
+            _slot_server(slot).sendmail(FROM_EMAIL, [to_ascii], msg_str)
+        slot.sent += 1
+        slot.last_used = time.monotonic()
+        if slot.sent >= SMTP_MAX_PER_CONN:
+            _close_slot(slot)
+
 # ---------------- Core ----------------
+@lru_cache(maxsize=32)
+def _get_tpl(template_name: str):
+    # template ชุดเล็กและคงที่ (auto_reload=False) → จำ Template object ไว้ ไม่ต้องผ่าน lock/cache ของ Jinja ทุกครั้ง
+    return env.get_template(template_name)
+
+def clear_template_caches():
+    """ล้าง template ที่ cache ไว้ (ทั้งของเราและของ Jinja) เช่นหลัง deploy template ใหม่โดยไม่ restart"""
+    _get_tpl.cache_clear()
+    env.cache.clear()
+    env.bytecode_cache.clear()
+
 def render_template(template_name: str, context: dict) -> str:
-    tpl = env.get_template(template_name)
-    html = tpl.render(**context)
-    return _sanitize(html)
+    return _sanitize(_get_tpl(template_name).render(**context))
 
 def send_email(to_email: str, subject: str, html_content: str) -> bool:
     """
@@ -97,56 +282,94 @@ def send_email(to_email: str, subject: str, html_content: str) -> bool:
 
     # Build message (UTF-8 content)
     msg = MIMEText(html_str, "html", "utf-8")
-    msg["Subject"] = str(Header(subject_str, "utf-8"))
-    msg["From"] = formataddr((str(Header(FROM_NAME, "utf-8")), FROM_EMAIL))
+    # ASCII ล้วนไม่ต้อง encode แบบ RFC 2047 (=?utf-8?b?...?=)
+    msg["Subject"] = subject_str if subject_str.isascii() else str(Header(subject_str, "utf-8"))
+    msg["From"] = _FROM_HEADER
     msg["To"] = to_ascii
 
     # Dry-run switch (useful locally)
     if DISABLE_EMAIL or not SMTP_USER or not SMTP_PASS:
-        print(f"[email_stub] Would send to {to_ascii}: {subject_str}")
+        log.info("[email_stub] Would send to %s: %s", to_ascii, subject_str)
         return True
 
     try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30) as server:
-            server.ehlo()
-            # TLS if supported
-            try:
-                server.starttls()
-                server.ehlo()
-            except smtplib.SMTPException:
-                pass
-            server.login(SMTP_USER, SMTP_PASS)  # Python encodes this as ASCII
-            server.sendmail(FROM_EMAIL, [to_ascii], msg.as_string())
+        _sendmail(to_ascii, msg.as_string())
         return True
-    except UnicodeEncodeError as e:
-        print(
-            f"[email_error] Non-ASCII in SMTP credentials/envelope caused login failure: {e}. "
-            "Please retype SMTP_USER/SMTP_PASS/FROM_EMAIL in the dashboard (avoid copy/paste)."
-        )
+    except smtplib.SMTPRecipientsRefused:
+        # ปัญหาที่ผู้รับรายนี้ — connection ยังใช้ต่อได้
+        log.exception("SMTP send failed")
         return False
-    except Exception as e:
-        print(f"[email_error] SMTP send failed: {e}")
+    except Exception:
+        log.exception("SMTP send failed")
+        # สถานะ connection ไม่แน่นอน → ทิ้ง ให้ฉบับถัดไปเปิดใหม่
+        close_smtp()
         return False
 
+def _fan_out(items, send_one, describe) -> tuple[int, int]:
+    """
+    กระจาย items ให้ EMAIL_WORKERS thread: แต่ละ thread ดึงชิ้นถัดไปเองจาก iterator ที่ใช้ร่วมกัน
+    แล้วส่งบน SMTP connection ของ thread นั้น (render + RTT ซ้อนกันได้; ไม่ต้องรอโหลดครบก่อน)
+    error ตอนอ่าน items (เช่น DB) → raise ให้ผู้เรียก
+    RETURN: (sent, failed)
+    """
+    it = iter(items)
+    lock = threading.Lock()
+    done = object()
+
+    def _next_item():
+        with lock:
+            return next(it, done)
+
+    def _worker() -> tuple[int, int]:
+        sent = failed = 0
+        try:
+            while (item := _next_item()) is not done:
+                try:
+                    if send_one(item):
+                        sent += 1
+                    else:
+                        failed += 1
+                except Exception:
+                    failed += 1
+                    log.exception("Send error to %s", describe(item))
+        finally:
+            close_smtp()
+        return sent, failed
+
+    with ThreadPoolExecutor(max_workers=EMAIL_WORKERS, thread_name_prefix="email") as pool:
+        futures = [pool.submit(_worker) for _ in range(EMAIL_WORKERS)]
+        results = [f.result() for f in futures]
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+def send_bulk(messages) -> int:
+    """
+    ส่งหลายฉบับพร้อมกันด้วย EMAIL_WORKERS connection: messages = [(to_email, subject, html), ...]
+    RETURN: จำนวนที่ส่งสำเร็จ (ปิด connection เมื่อจบ)
+    """
+    sent, _ = _fan_out(messages, lambda m: send_email(*m), lambda m: m[0])
+    return sent
+
+# template + หัวเรื่องของแต่ละ Day (สร้างครั้งเดียวตอน import; ตอนส่งแค่ .format ชื่อ agent)
+_TRIAL_TEMPLATES = {
+    1: "email_day1.html",
+    10: "email_day10.html",
+    23: "email_day23.html",
+}
+_TRIAL_SUBJECTS = {
+    1: "Welcome to {agent_name}!",
+    10: "Day 10: Tips to get more from {agent_name}",
+    23: "Day 23: You're close—unlock full power of {agent_name}",
+}
+
 def send_trial_email(day: int, user: dict, agent_name: str, links: dict) -> bool:
     """
     Helper for the scheduler (Day 1 / 10 / 23).
     """
-    template_map = {
-        1: "email_day1.html",
-        10: "email_day10.html",
-        23: "email_day23.html",
-    }
-    template_file = template_map.get(day)
+    template_file = _TRIAL_TEMPLATES.get(day)
     if not template_file:
         return False
 
-    subject_map = {
-        1: f"Welcome to {agent_name}!",
-        10: f"Day 10: Tips to get more from {agent_name}",
-        23: f"Day 23: You're close—unlock full power of {agent_name}",
-    }
-    subject = subject_map[day]
+    subject = _TRIAL_SUBJECTS[day].format(agent_name=agent_name)
 
     context = {
         "first_name": user.get("first_name", "there"),
@@ -160,3 +383,15 @@ def send_trial_email(day: int, user: dict, agent_name: str, links: dict) -> bool
 
     html = render_template(template_file, context)
     return send_email(user["user_email"], subject, html)
+
+def send_trial_batch(day: int, users, agent_name: str, links: dict) -> tuple[int, int]:
+    """
+    ส่งอีเมล trial ให้ผู้ใช้หลายคนพร้อมกันด้วย EMAIL_WORKERS thread
+    users เป็น iterable ใดก็ได้ (list หรือ generator ที่ stream จาก DB)
+    RETURN: (sent, failed)
+    """
+    return _fan_out(
+        users,
+        lambda user: send_trial_email(day, user, agent_name, links),
+        lambda user: f"{user.get('user_email')} (Day {day})",
+    )
@@ -1,9 +1,12 @@
 # app/enterprise.py
-import os
+import logging
 from typing import Optional, Dict, Any, Iterable, List
 
-import psycopg
-from psycopg.rows import dict_row
+from app.db import _connect  # ใช้ connection pool เดียวกับ app.db (row_factory=dict_row)
+# ใช้ TTL cache สิทธิ์ของ app.db: ฟังก์ชันเขียนใน app.db (upsert_*/drain) ล้างให้เองผ่าน invalidate_entitlement
+from app.db import _MISS, _ent_cache_get, _ent_cache_set, invalidate_entitlement
+
+log = logging.getLogger("thanyaaura.gateway.enterprise")
 
 # ---------------------------------------------
 # Plan definitions (คงเดิม)
@@ -44,12 +47,6 @@ RANK = {
 # ---------------------------------------------
 # DB utils
 # ---------------------------------------------
-def _connect():
-    url = os.environ.get("DATABASE_URL") or os.environ.get("DB_URL")
-    if not url:
-        raise RuntimeError("DATABASE_URL/DB_URL is not set")
-    return psycopg.connect(url, row_factory=dict_row)
-
 def _extract_domain(email: str) -> Optional[str]:
     email = (email or "").strip().lower()
     return email.split("@", 1)[1] if "@" in email else None
@@ -102,9 +99,10 @@ def _features_for(plan: str, seats: Optional[int] = None) -> Dict[str, Any]:
 # ---------------------------------------------
 # Core: enterprise entitlement resolvers
 # ---------------------------------------------
-def _plans_from_enterprise_licenses(domain: str) -> List[str]:
+def _plans_from_enterprise_licenses(domain: str) -> Optional[List[str]]:
     """
     อ่าน active แถวจาก enterprise_licenses ของโดเมน แล้วแปลงเป็นรายชื่อ plan
+    RETURN None เมื่อ DB error (ผู้เรียกจะไม่ cache ผลรอบนั้น)
     """
     d = (domain or "").strip().lower()
     if not d:
@@ -121,9 +119,9 @@ def _plans_from_enterprise_licenses(domain: str) -> List[str]:
         with _connect() as conn, conn.cursor() as cur:
             cur.execute(sql, (d,))
             rows = cur.fetchall()
-    except Exception as ex:
-        print(f"DB error (enterprise_licenses lookup): {ex}")
-        return []
+    except Exception:
+        log.exception("DB error (enterprise_licenses lookup)")
+        return None
 
     plans: List[str] = []
     for r in rows:
@@ -133,21 +131,18 @@ def _plans_from_enterprise_licenses(domain: str) -> List[str]:
             plans.append(plan)
     return plans
 
-def entitlements_for_email(email: str) -> Optional[Dict[str, Any]]:
+def _resolve_for_email(email: str):
     """
     Determine enterprise entitlement for a user by:
       1) PRIMARY: look up domain in enterprise_licenses (active rows)
       2) FALLBACK: look up personal 'en_%' subscriptions for that email (ของเดิม)
+    RETURN (entitlement | None, cacheable)
     """
-    email = (email or "").strip().lower()
-    if not email:
-        return None
     domain = _extract_domain(email)
-    if not domain:
-        return None
 
     # 1) PRIMARY: enterprise_licenses by domain
     plans = _plans_from_enterprise_licenses(domain)
+    primary_ok = plans is not None
     if plans:
         plan = _pick_highest(plans)
         feats = _features_for(plan) if plan else {}
@@ -160,7 +155,7 @@ def entitlements_for_email(email: str) -> Optional[Dict[str, Any]]:
             "features": feats,
             "expires_at": None,   # สามารถดึง expires_at ล่าสุดมาใส่ได้ ถ้าต้องการ
             "source": "enterprise_licenses",
-        }
+        }, True
 
     # 2) FALLBACK: เดิมอ่านจาก subscriptions ของ email นี้ (en_%)
     with _connect() as conn, conn.cursor() as cur:
@@ -179,7 +174,7 @@ def entitlements_for_email(email: str) -> Optional[Dict[str, Any]]:
     plans = [_plan_from_en_sku(r["sku"]) for r in rows if r.get("sku")]
     plans = [p for p in plans if p]
     if not plans:
-        return None
+        return None, primary_ok
 
     plan = _pick_highest(plans)
     feats = _features_for(plan)
@@ -193,20 +188,19 @@ def entitlements_for_email(email: str) -> Optional[Dict[str, Any]]:
         "features": feats,
         "expires_at": None,
         "source": "subscriptions",  # fallback แสดงที่มา
-    }
+    }, primary_ok
 
-def entitlements_for_domain(domain: str) -> Optional[Dict[str, Any]]:
+def _resolve_for_domain(domain: str):
     """
     Company-level check:
       1) PRIMARY: active enterprise_licenses for this domain
       2) FALLBACK: any active 'en_%' SKU in subscriptions for users under this domain (ของเดิม)
+    RETURN (entitlement | None, cacheable)
     """
-    domain = (domain or "").strip().lower()
-    if not domain:
-        return None
 
     # 1) PRIMARY: enterprise_licenses
     plans = _plans_from_enterprise_licenses(domain)
+    primary_ok = plans is not None
     if plans:
         plan = _pick_highest(plans)
         feats = _features_for(plan) if plan else {}
@@ -219,7 +213,7 @@ def entitlements_for_domain(domain: str) -> Optional[Dict[str, Any]]:
             "features": feats,
             "expires_at": None,
             "source": "enterprise_licenses",
-        }
+        }, True
 
     # 2) FALLBACK: subscriptions (ของเดิม)
     with _connect() as conn, conn.cursor() as cur:
@@ -238,7 +232,7 @@ def entitlements_for_domain(domain: str) -> Optional[Dict[str, Any]]:
     plans = [_plan_from_en_sku(r["sku"]) for r in rows if r.get("sku")]
     plans = [p for p in plans if p]
     if not plans:
-        return None
+        return None, primary_ok
 
     plan = _pick_highest(plans)
     feats = _features_for(plan)
@@ -252,10 +246,37 @@ def entitlements_for_domain(domain: str) -> Optional[Dict[str, Any]]:
         "features": feats,
         "expires_at": None,
         "source": "subscriptions",  # fallback แสดงที่มา
-    }
+    }, primary_ok
+
+def _cached(key, resolve, arg) -> Optional[Dict[str, Any]]:
+    hit = _ent_cache_get(key)
+    if hit is not _MISS:
+        return dict(hit) if hit else hit
+    ent, cacheable = resolve(arg)
+    # ไม่ cache เมื่อ enterprise_licenses อ่านไม่สำเร็จ (กันผล fallback ค้างนาน ENT_TTL)
+    if cacheable:
+        _ent_cache_set(key, ent)
+    # คืนสำเนา: ผู้เรียก (เช่น /entitlements/company) เติม key ลง dict ได้โดยไม่กระทบ cache
+    return dict(ent) if ent else ent
+
+def entitlements_for_email(email: str) -> Optional[Dict[str, Any]]:
+    email = (email or "").strip().lower()
+    if not _extract_domain(email):
+        return None
+    return _cached(("enterprise_email", email), _resolve_for_email, email)
+
+def entitlements_for_domain(domain: str) -> Optional[Dict[str, Any]]:
+    domain = (domain or "").strip().lower()
+    if not domain:
+        return None
+    return _cached(("enterprise", domain), _resolve_for_domain, domain)
 
 # ---------------------------------------------
-# Keep webhook hook for compatibility with main.py (no-op here)
+# Webhook hook (main.py เรียกก่อนเขียน DB)
 # ---------------------------------------------
 def apply_thrivecart_event(payload: Dict[str, Any]):  # type: ignore[valid-type]
+    """ล้าง cache สิทธิ์ของผู้ซื้อ/โดเมน (upsert ใน app.db ล้างซ้ำอีกรอบหลังเขียนเสร็จ)"""
+    email = (payload.get("customer[email]") or payload.get("email") or "").strip().lower()
+    if email:
+        invalidate_entitlement(email=email)
     return None
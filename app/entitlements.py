@@ -8,8 +8,9 @@ from fastapi import HTTPException
 # โมดูลเดิมของคุณ (ยังคงเรียกก่อน ถ้า error ค่อย fallback DB)
 from app import enterprise, individual  # noqa
 
-# เพิ่ม psycopg สำหรับ fallback DB query แบบปลอดภัย
-import psycopg
+# fallback DB query: ใช้ connection pool เดียวกับ app.db (autocommit) แต่อ่านแถวเป็น tuple
+from psycopg.rows import tuple_row
+from app.db import _connect
 
 log = logging.getLogger("thanyaaura.entitlements")
 
@@ -39,16 +40,6 @@ def _normalize(ent: Dict, scope: str) -> Dict:
     }
 
 # --------------------- Fallback DB helpers (ใหม่) ---------------------
-def _db_url() -> str:
-    url = os.getenv("DATABASE_URL") or os.getenv("DB_URL")
-    if not url:
-        raise RuntimeError("DATABASE_URL/DB_URL is not set")
-    return url
-
-def _connect():
-    # psycopg3
-    return psycopg.connect(_db_url(), autocommit=True)
-
 def _fetch_agent_entitlements(email: str) -> List[Tuple[str, str]]:
     """
     คืนรายการ (agent_slug_or_sku, platform)
@@ -56,7 +47,7 @@ def _fetch_agent_entitlements(email: str) -> List[Tuple[str, str]]:
     """
     rows: List[Tuple[str, str]] = []
     with _connect() as conn:
-        with conn.cursor() as cur:
+        with conn.cursor(row_factory=tuple_row) as cur:
             # agent_slug ถ้ามี
             try:
                 cur.execute(
@@ -96,7 +87,7 @@ def _fetch_tier_subscriptions(email: str) -> List[Tuple[str, str]]:
     """
     rows: List[Tuple[str, str]] = []
     with _connect() as conn:
-        with conn.cursor() as cur:
+        with conn.cursor(row_factory=tuple_row) as cur:
             try:
                 cur.execute(
                     """
@@ -119,7 +110,7 @@ def _fetch_enterprise_licenses(email: str) -> List[Tuple[str, str]]:
     """
     rows: List[Tuple[str, str]] = []
     with _connect() as conn:
-        with conn.cursor() as cur:
+        with conn.cursor(row_factory=tuple_row) as cur:
             try:
                 cur.execute(
                     """
@@ -1,9 +1,7 @@
 # app/individual.py
-import os
 from typing import Optional, Dict, Any, Iterable
 
-import psycopg
-from psycopg.rows import dict_row
+from app.db import _connect  # ใช้ connection pool เดียวกับ app.db (row_factory=dict_row)
 
 # Feature sets per individual tier (customize if needed)
 INDIVIDUAL_FEATURES: Dict[str, Dict[str, Any]] = {
@@ -20,12 +18,6 @@ TIER_ALIASES = {
     "premium": "Premium",   "tier_premium": "Premium",
 }
 
-def _connect():
-    url = os.environ.get("DATABASE_URL") or os.environ.get("DB_URL")
-    if not url:
-        raise RuntimeError("DATABASE_URL/DB_URL is not set")
-    return psycopg.connect(url, row_factory=dict_row)
-
 def _tier_from_sku(sku: str) -> Optional[str]:
     s = (sku or "").strip().lower()
     return TIER_ALIASES.get(s)
@@ -0,0 +1,103 @@
+# app/jwt_verify.py
+"""
+ตรวจ Bearer JWT (OAuth2 / Entra ID) ใช้ร่วมกันทั้ง app.main และ app.api_run
+- JWKS cache ตาม JWKS_TTL + force refresh เมื่อเจอ kid ใหม่ (จำกัดไม่ถี่กว่า _JWKS_MIN_REFRESH)
+- cache claims ที่ verify แล้ว (key = digest ของ token) → ข้าม RSA verify เมื่อ token เดิมถูกใช้ซ้ำ
+ทั้ง process มี cache ชุดเดียว ไม่ว่าจะเข้าทาง route ไหน
+"""
+import os
+import time
+import hashlib
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+from cachetools import TTLCache
+from fastapi import HTTPException
+
+log = logging.getLogger("thanyaaura.gateway.jwt")
+
+jose_available = True
+try:
+    from jose import jwt, jwk  # type: ignore
+except Exception:
+    jose_available = False
+
+JWKS_URL   = os.getenv("JWKS_URL")        # e.g. https://login.microsoftonline.com/<tenant>/discovery/v2.0/keys
+OAUTH_ISS  = os.getenv("OAUTH_ISSUER")    # e.g. https://login.microsoftonline.com/<tenant>/v2.0
+OAUTH_AUD  = os.getenv("OAUTH_AUDIENCE")  # e.g. api://<app-id> or client_id
+
+JWKS_TTL = int(os.getenv("JWKS_TTL", "600"))  # วินาที (รองรับ key rotation)
+_JWKS_MIN_REFRESH = 60  # กัน token ปลอม (kid มั่ว) ยิงให้ refetch ถี่เกินไป
+_JWKS_CACHE: Dict[str, Any] = {"exp": 0.0, "fetched": 0.0, "by_kid": None}
+# client เดียวใช้ซ้ำ (pool TCP/TLS) และไม่บล็อก event loop ตอน cache miss
+_jwks_http = httpx.AsyncClient(timeout=10)
+
+CLAIMS_CACHE_TTL = int(os.getenv("CLAIMS_CACHE_TTL", "300"))
+_CLAIMS_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=CLAIMS_CACHE_TTL)
+_CLAIMS_EXP_SKEW = 30  # วินาที: token ใกล้หมดอายุให้ verify ใหม่
+
+def is_configured() -> bool:
+    return jose_available and bool(JWKS_URL and OAUTH_AUD and OAUTH_ISS)
+
+def _token_cache_key(token: str) -> str:
+    return hashlib.blake2b(token.encode("utf-8"), digest_size=16).hexdigest()
+
+def _build_jwk_index(jwks: Dict[str, Any]) -> Dict[str, Tuple[Any, str]]:
+    """
+    kid -> (jose Key ที่ parse แล้ว, alg) — parse JWK ครั้งเดียวตอนโหลด JWKS
+    แทนที่ jwt.decode จะต้อง construct key ใหม่ทุก token
+    """
+    out: Dict[str, Tuple[Any, str]] = {}
+    for k in jwks.get("keys", []):
+        alg = k.get("alg") or "RS256"
+        try:
+            out[k.get("kid")] = (jwk.construct(k, alg), alg)
+        except Exception as e:
+            log.warning("Skipping unusable JWK kid=%s: %s", k.get("kid"), e)
+    return out
+
+async def get_jwks(force: bool = False) -> Dict[str, Tuple[Any, str]]:
+    now = time.monotonic()
+    if force and now - _JWKS_CACHE["fetched"] < _JWKS_MIN_REFRESH:
+        force = False
+    if force or _JWKS_CACHE["by_kid"] is None or now > _JWKS_CACHE["exp"]:
+        resp = await _jwks_http.get(JWKS_URL)
+        resp.raise_for_status()
+        _JWKS_CACHE["by_kid"] = _build_jwk_index(resp.json())
+        _JWKS_CACHE["fetched"] = now
+        _JWKS_CACHE["exp"] = now + JWKS_TTL
+    return _JWKS_CACHE["by_kid"]
+
+async def decode_token(token: str) -> Dict[str, Any]:
+    """
+    verify token กับ JWKS แล้วคืน claims (ผ่าน claims cache)
+    - kid ไม่รู้จักแม้ refresh แล้ว → HTTPException 401
+    - error อื่นของ jose/httpx ส่งต่อให้ผู้เรียกจัดการเอง
+    """
+    if not is_configured():
+        raise HTTPException(status_code=500, detail="JWT verification not configured")
+    ck = _token_cache_key(token)
+    cached = _CLAIMS_CACHE.get(ck)
+    if cached is not None and float(cached.get("exp") or 0) > time.time() + _CLAIMS_EXP_SKEW:
+        return cached
+    kid = jwt.get_unverified_header(token).get("kid")
+    entry = (await get_jwks()).get(kid)
+    if not entry:
+        # kid ใหม่ (IdP เพิ่ง rotate key) → refresh JWKS หนึ่งครั้งก่อนปฏิเสธ
+        entry = (await get_jwks(force=True)).get(kid)
+    if not entry:
+        raise HTTPException(status_code=401, detail="Unknown token key id")
+    key, alg = entry
+    claims = jwt.decode(token, key, algorithms=[alg], audience=OAUTH_AUD, issuer=OAUTH_ISS)
+    _CLAIMS_CACHE[ck] = claims
+    return claims
+
+async def aclose():
+    await _jwks_http.aclose()
+
+__all__ = [
+    "JWKS_URL", "OAUTH_ISS", "OAUTH_AUD",
+    "jose_available", "is_configured",
+    "get_jwks", "decode_token", "aclose",
+]
@@ -1,7 +1,7 @@
 # app/limits.py
 import hashlib
+import inspect
 import logging
-from datetime import datetime, timezone
 from typing import Any, Optional
 
 from fastapi import HTTPException, Request
@@ -20,11 +20,6 @@ LIMITS_DEGRADE_OK = os.getenv("LIMITS_DEGRADE_OK", "1") == "1"
 LIMITS_REQUIRE_API_KEY = os.getenv("LIMITS_REQUIRE_API_KEY", "1") == "1"
 
 
-def _yyyymm_now() -> str:
-    dt = datetime.now(timezone.utc)
-    return f"{dt.year:04d}-{dt.month:02d}"
-
-
 async def _db_safe_call(db: Any, fn_name: str, *args, default=None, **kwargs):
     """
     เรียกเมธอดใน app.db แบบปลอดภัย + รองรับทั้ง sync/async:
@@ -36,9 +31,8 @@ async def _db_safe_call(db: Any, fn_name: str, *args, default=None, **kwargs):
         if not callable(fn):
             log.warning("DB method missing: %s", fn_name)
             return default
-        # ตรวจว่าเป็น coroutine หรือไม่
-        if getattr(fn, "__await__", None) is not None:
-            # async function
+        # ตรวจว่าเป็น coroutine function หรือไม่ (async sibling ใน app.db เช่น afetch_*/aupsert_*)
+        if inspect.iscoroutinefunction(fn):
             return await fn(*args, **kwargs)
         # sync function → รันใน threadpool
         return await run_in_threadpool(fn, *args, **kwargs)
@@ -70,19 +64,19 @@ def _get_api_key_from_request(request: Request) -> Optional[str]:
     return None
 
 
-async def _choose_usage_bucket(db, tenant_id: int, sub: dict) -> str:
+async def _choose_usage_bucket(db, tenant_id: int, sub: dict) -> Optional[str]:
     """
     คืน key ของ usage bucket รายเดือน
     - ถ้ามี DB helper เฉพาะ (get_usage_bucket_key) ให้ใช้
-    - ไม่มีก็ fallback เป็น YYYY-MM (UTC)
+    - ไม่มีก็คืน None → DB คำนวณ YYYY-MM (เวลา UTC เหมือน fallback เดิมฝั่ง Python) เองในคำสั่ง charge_call
     หมายเหตุ: ถ้าอยาก align กับวัน renew (renew_day) จริง ๆ ให้ทำ helper ใน DB แล้วเมธอดนี้จะเรียกใช้
     """
     # ลองใช้ helper จาก DB ถ้ามี
     key = await _db_safe_call(db, "get_usage_bucket_key", tenant_id, sub, default=None)
     if isinstance(key, str) and key:
         return key
-    # fallback: ปฏิทินรายเดือนแบบ UTC
-    return _yyyymm_now()
+    # fallback: ให้ DB คำนวณเดือนปัจจุบันเอง (ทุก worker ได้ค่าเดียวกัน)
+    return None
 
 
 async def require_tenant_and_quota(request: Request, agent_slug: str):
@@ -168,43 +162,29 @@ async def require_tenant_and_quota(request: Request, agent_slug: str):
     bucket_key = await _choose_usage_bucket(db, int(tenant_id), sub)
 
     idem = request.headers.get("X-Idempotency-Key")
-    # ถ้า idempotency key เคยใช้แล้ว -> ผ่านโดยไม่หัก quota ซ้ำ
-    seen = await _db_safe_call(db, "seen_idempotency", tenant_id, idem, default=False) if idem else False
-    if seen:
-        request.state.tenant_id = tenant_id
-        request.state.plan_code = plan_code
-        request.state.quota_checked = False
-        return
-
-    # สร้าง bucket ถ้ายังไม่มี
-    await _db_safe_call(db, "ensure_usage_bucket", tenant_id, bucket_key, default=True)
-
-    used = await _db_safe_call(db, "get_calls_used", tenant_id, bucket_key, default=0)
     base_quota = int(sub.get("monthly_quota", 0) or 0)
     extra_quota = int(sub.get("extra_quota_balance", 0) or 0)
     limit = base_quota + extra_quota
 
-    # ถ้า DB ไม่พร้อม/คืน None → degrade (ตาม flag)
-    if used is None:
-        _fail_or_degrade("get_calls_used returned None")
+    # กันนับซ้ำ + ตรวจโควตา + จอง 1 call ใน round-trip เดียว (atomic)
+    charge = await _db_safe_call(db, "charge_call", tenant_id, bucket_key, idem, limit, 1, default=None)
+    if charge is None:
+        _fail_or_degrade("charge_call failed")
         request.state.tenant_id = tenant_id
         request.state.plan_code = plan_code
         request.state.quota_checked = False
         return
 
-    if limit > 0 and used >= limit:
-        raise HTTPException(status_code=403, detail="Monthly quota exceeded")
+    # ถ้า idempotency key เคยใช้แล้ว -> ผ่านโดยไม่หัก quota ซ้ำ
+    if not charge.get("first_seen"):
+        request.state.tenant_id = tenant_id
+        request.state.plan_code = plan_code
+        request.state.quota_checked = False
+        return
 
-    # จอง 1 call (optimistic)
-    ok = await _db_safe_call(db, "increment_calls_used", tenant_id, bucket_key, 1, default=True)
-    if not ok:
-        # กัน race: ถ้าเพิ่มไม่ได้ให้ถือว่า quota เต็ม
+    if not charge.get("charged"):
         raise HTTPException(status_code=403, detail="Monthly quota exceeded")
 
-    # ทำเครื่องหมาย idempotency key
-    if idem:
-        await _db_safe_call(db, "write_idempotency", tenant_id, idem, default=True)
-
     # expose state ให้ปลายทาง (ใช้แสดงผล/ดีบัก)
     request.state.tenant_id = tenant_id
     request.state.plan_code = plan_code
@@ -6,10 +6,12 @@ import importlib
 import logging
 from urllib.parse import urlparse
 from json import JSONDecodeError
-from typing import Optional, Dict, Any, Tuple, List, Literal
+from typing import Optional, Dict, Any, Tuple, List, Literal, Annotated
 
+import httpx
 from fastapi import FastAPI, HTTPException, Request, Depends, Response, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.routing import APIRoute
 from starlette.concurrency import run_in_threadpool
 
@@ -177,7 +179,8 @@ except Exception as e:
     classify_agent_tier = None  # type: ignore
     log.warning("agent_tiers.classify_agent_tier not available (%s). Tier-based checks limited.", e)
 
-app = FastAPI(title="Thanyaaura Gateway", version="1.9.4")
+# ORJSONResponse: serialize ผลลัพธ์ agent (dict ซ้อนขนาดใหญ่) เร็วกว่า stdlib json
+app = FastAPI(title="Thanyaaura Gateway", version="1.9.4", default_response_class=ORJSONResponse)
 
 # ---------- CORS ----------
 def _parse_csv_env(name: str, default_list: list[str]) -> list[str]:
@@ -479,7 +482,7 @@ if IS_DEBUG_ROUTES:
     async def debug_db_ping():
         try:
             dbmod = _db()
-            info = await run_in_threadpool(dbmod.ping_db)
+            info = await dbmod.aping_db()
             return info
         except Exception as ex_dbping:
             return {"ok": False, "error": str(ex_dbping)}
@@ -551,7 +554,7 @@ async def entitlements_company(domain: str):
     tags=["agents"],
     dependencies=[Depends(require_api_key)],
 )
-async def run_agent(sku: str, req: RunAgentRequest):
+async def run_agent(sku: str, req: RunAgentRequest, request: Request):
     user_email = req.email
     agent_slug, platform = require_entitlement_or_403(user_email, sku)
 
@@ -565,7 +568,7 @@ async def run_agent(sku: str, req: RunAgentRequest):
         except Exception:
             AgentRunner = None
         if AgentRunner:
-            runner = AgentRunner()
+            runner = AgentRunner(http_client=getattr(request.app.state, "http", None))
             out = await runner.run(agent_slug=agent_slug, provider=None, model_override=None, payload=(req.payload or {}))
             result = {"agent": agent_slug, "platform": platform, "result": out}
     except Exception as e:
@@ -746,25 +749,20 @@ async def billing_thrivecart(request: Request):
     # Optional hook (best-effort)
     if enterprise_api:
         try:
-            enterprise_api.apply_thrivecart_event(data)  # no-op in current enterprise.py
+            enterprise_api.apply_thrivecart_event(data)  # ล้าง cache สิทธิ์ enterprise ของผู้ซื้อ
         except Exception as e:
             log.warning("apply_thrivecart_event failed: %s", e)
 
     dbmod = _db()
     try:
         if short_sku.startswith("en_"):
-            await run_in_threadpool(
-                dbmod.upsert_enterprise_license, order_id, email, short_sku, agent_slug, platform
-            )
+            await dbmod.aupsert_enterprise_license(order_id, email, short_sku, agent_slug, platform)
             ttype = "ENTERPRISE"
         elif tier_code:
-            await run_in_threadpool(
-                dbmod.upsert_tier_subscription, order_id, email, short_sku, tier_code, platform
-            )
+            await dbmod.aupsert_tier_subscription(order_id, email, short_sku, tier_code, platform)
             ttype = "TIER"
         else:
-            await run_in_threadpool(
-                dbmod.upsert_subscription_and_entitlement,
+            await dbmod.aupsert_subscription_and_entitlement(
                 order_id,
                 email,
                 short_sku,
@@ -791,15 +789,8 @@ async def billing_thrivecart(request: Request):
 ALLOW_DEV_BEARER = os.getenv("ALLOW_DEV_BEARER", "0") == "1"
 REQUIRED_SCOPE = os.getenv("OAUTH_REQUIRED_SCOPE", "read")
 
-JWKS_URL   = os.getenv("JWKS_URL")        # e.g. https://login.microsoftonline.com/<tenant>/discovery/v2.0/keys
-OAUTH_ISS  = os.getenv("OAUTH_ISSUER")    # e.g. https://login.microsoftonline.com/<tenant>/v2.0
-OAUTH_AUD  = os.getenv("OAUTH_AUDIENCE")  # e.g. api://<app-id> or client_id
-
-_jose_available = True
-try:
-    from jose import jwt  # type: ignore
-except Exception:
-    _jose_available = False
+# JWKS / claims cache อยู่ที่ app.jwt_verify (ใช้ชุดเดียวกับ app.api_run)
+from app import jwt_verify
 
 def _extract_bearer(authz: Optional[str]) -> Optional[str]:
     if not authz:
@@ -826,26 +817,13 @@ def _require_scope_in_claims(claims: Dict[str, Any], scope: str):
     if scope not in scope_set:
         raise HTTPException(status_code=403, detail=f"Missing scope: {scope}")
 
-from functools import lru_cache
-@lru_cache(maxsize=1)
-def _get_jwks():
-    import requests  # lazy import
-    resp = requests.get(JWKS_URL, timeout=10)
-    resp.raise_for_status()
-    return resp.json()
-
-def _decode_bearer_token(token: str) -> Dict[str, Any]:
-    if not _jose_available or not (JWKS_URL and OAUTH_AUD and OAUTH_ISS):
+async def _decode_bearer_token(token: str) -> Dict[str, Any]:
+    if not jwt_verify.is_configured():
         if ALLOW_DEV_BEARER:
             return {"scp": REQUIRED_SCOPE, "preferred_username": os.getenv("DEV_EMAIL", "dev@example.com")}
         raise HTTPException(status_code=500, detail="JWT verification not configured")
     try:
-        unverified = jwt.get_unverified_header(token)
-        keys = _get_jwks().get("keys", [])
-        key = next((k for k in keys if k.get("kid") == unverified.get("kid")), None)
-        if not key:
-            raise HTTPException(status_code=401, detail="Unknown token key id")
-        return jwt.decode(token, key, algorithms=[unverified.get("alg", "RS256")], audience=OAUTH_AUD, issuer=OAUTH_ISS)
+        return await jwt_verify.decode_token(token)
     except HTTPException:
         raise
     except Exception as e:
@@ -853,16 +831,17 @@ def _decode_bearer_token(token: str) -> Dict[str, Any]:
         raise HTTPException(status_code=401, detail="Invalid token")
 
 # ---------------------- /v1/run models ----------------------
-from pydantic import BaseModel, Field, ConfigDict, constr
+from pydantic import BaseModel, Field, ConfigDict, StringConstraints
 
 Role = Literal["system", "user", "assistant"]
+NonEmptyStr = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
 
 class ChatMessage(BaseModel):
     role: Role
-    content: constr(strip_whitespace=True, min_length=1)
+    content: NonEmptyStr
 
 class V1RunRequest(BaseModel):
-    agent_slug: constr(strip_whitespace=True, min_length=1)
+    agent_slug: NonEmptyStr
     provider: Optional[Literal["openai", "gemini", "endpoint"]] = Field(default=None)
     model: Optional[str] = Field(default=None)
     input: Dict[str, Any] = Field(default_factory=dict)
@@ -884,7 +863,7 @@ async def v1_run(
     if not token and not ALLOW_DEV_BEARER:
         raise HTTPException(status_code=401, detail="Missing Bearer token")
 
-    claims = _decode_bearer_token(token) if token else {"scp": REQUIRED_SCOPE, "preferred_username": os.getenv("DEV_EMAIL", "dev@example.com")}
+    claims = await _decode_bearer_token(token) if token else {"scp": REQUIRED_SCOPE, "preferred_username": os.getenv("DEV_EMAIL", "dev@example.com")}
     _require_scope_in_claims(claims, REQUIRED_SCOPE)
 
     user_email = _email_from_claims(claims)
@@ -910,7 +889,8 @@ async def v1_run(
         log.warning("limits module not loaded; skipping quota checks for /v1/run.")
 
     # ตรวจ entitlement โดยตรงจาก agent_slug (tier-aware for Copilot Enterprise)
-    require_entitlement_for_agent_slug_or_403(user_email, req.agent_slug, platform)
+    # (sync DB → threadpool; ผลอ่านสิทธิ์ cache อยู่ที่ app.db ชุดเดียว ล้างด้วย invalidate_entitlement() ตอนเขียน)
+    await run_in_threadpool(require_entitlement_for_agent_slug_or_403, user_email, req.agent_slug, platform)
 
     # ---- Try to dispatch to real runner if available ----
     payload: Dict[str, Any] = req.input or {}
@@ -925,7 +905,7 @@ async def v1_run(
             AgentRunner = None
 
         if AgentRunner:
-            runner = AgentRunner()
+            runner = AgentRunner(http_client=getattr(request.app.state, "http", None))
             out = await runner.run(
                 agent_slug=req.agent_slug,
                 provider=req.provider,
@@ -955,6 +935,28 @@ async def v1_run(
     return V1RunResponse(ok=True, result=result)
 
 # ---------------------- Startup ----------------------
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "50"))
+
+@app.on_event("startup")
+async def open_http_client():
+    # client เดียวทั้ง process สำหรับเรียก provider/agent ปลายทาง: keep-alive + HTTP/2
+    # ไม่ต้อง handshake TCP/TLS ใหม่ทุก request
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+        timeout=httpx.Timeout(60),
+    )
+
+@app.on_event("startup")
+async def run_db_migrations():
+    # สร้าง/อัปเดต schema ครั้งเดียวตอนสตาร์ต (ไม่ทำใน request path)
+    try:
+        dbmod = importlib.import_module("app.db")
+        await run_in_threadpool(dbmod.migrate)
+    except Exception as ex:
+        log.warning("DB migration failed at startup: %s", ex)
+
 @app.on_event("startup")
 async def ensure_admin_on_startup():
     try:
@@ -968,6 +970,20 @@ async def ensure_admin_on_startup():
         except Exception as e2:
             log.warning("app.db not importable for request state: %s", e2)
 
+@app.on_event("shutdown")
+async def close_http_clients():
+    await jwt_verify.aclose()
+    http = getattr(app.state, "http", None)
+    if http is not None:
+        await http.aclose()
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    dbmod = getattr(app.state, "db", None)
+    if dbmod is not None and hasattr(dbmod, "close_pool"):
+        await dbmod.aclose_pool()
+        await run_in_threadpool(dbmod.close_pool)
+
 # ---------------------- HEAD / (avoid 405 in probes) ----------------------
 @app.head("/")
 def head_root():
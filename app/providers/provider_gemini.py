@@ -2,8 +2,9 @@ import os, httpx
 from app.config import GEMINI_API_KEY, MODEL_DEFAULT_GEMINI
 
 class GeminiProvider:
-    def __init__(self, api_key: str | None = None):
+    def __init__(self, api_key: str | None = None, http_client: httpx.AsyncClient | None = None):
         self.api_key = api_key or GEMINI_API_KEY
+        self.http = http_client  # shared pooled client (keep-alive); None = one-off client per call
 
     async def chat(self, messages: list, model: str | None = None) -> dict:
         # Convert OpenAI-style messages to Gemini's contents
@@ -15,7 +16,10 @@ class GeminiProvider:
 
         url = f"https://generativelanguage.googleapis.com/v1beta/models/{model or MODEL_DEFAULT_GEMINI}:generateContent?key={self.api_key}"
         payload = {"contents": contents}
-        async with httpx.AsyncClient(timeout=60) as client:
-            r = await client.post(url, json=payload)
-            r.raise_for_status()
-            return r.json()
+        if self.http is not None:
+            r = await self.http.post(url, json=payload, timeout=60)
+        else:
+            async with httpx.AsyncClient(timeout=60) as client:
+                r = await client.post(url, json=payload)
+        r.raise_for_status()
+        return r.json()
@@ -3,9 +3,9 @@ from app.providers.provider_gemini import GeminiProvider
 from app.agents import AGENT_SPECS
 
 class AgentRunner:
-    def __init__(self):
-        self.openai = OpenAIProvider()
-        self.gemini = GeminiProvider()
+    def __init__(self, http_client=None):
+        self.openai = OpenAIProvider(http_client=http_client)
+        self.gemini = GeminiProvider(http_client=http_client)
 
     async def run(self, agent_slug: str, provider: str | None, messages: list | None, model_override: str | None = None):
         spec = AGENT_SPECS.get(agent_slug)
@@ -1,52 +1,47 @@
+from typing import NamedTuple
+
 from .provider_openai import OpenAIProvider
 from .provider_dummy import DummyProvider
 
-AGENT_SPECS = {
-    "CFS": {"provider":"openai"},
-    "CFP": {"provider":"openai"},
-    "CFPR": {"provider":"openai"},
-    "REVS": {"provider":"openai"},
-    "REVP": {"provider":"openai"},
-    "REVPR": {"provider":"openai"},
-    "CAPEXS": {"provider":"openai"},
-    "CAPEXP": {"provider":"openai"},
-    "CAPEXPR": {"provider":"openai"},
-    "FXS": {"provider":"openai"},
-    "FXP": {"provider":"openai"},
-    "FXPR": {"provider":"openai"},
-    "COSTS": {"provider":"openai"},
-    "COSTP": {"provider":"openai"},
-    "COSTPR": {"provider":"openai"},
-    "BUDS": {"provider":"openai"},
-    "BUDP": {"provider":"openai"},
-    "BUDPR": {"provider":"openai"},
-    "REPS": {"provider":"openai"},
-    "REPP": {"provider":"openai"},
-    "REPPR": {"provider":"openai"},
-    "VARS": {"provider":"openai"},
-    "VARP": {"provider":"openai"},
-    "VARPR": {"provider":"openai"},
-    "MARS": {"provider":"openai"},
-    "MARP": {"provider":"openai"},
-    "MARPR": {"provider":"openai"},
-    "FORS": {"provider":"openai"},
-    "FORP": {"provider":"openai"},
-    "FORPR": {"provider":"openai"},
-    "DECS": {"provider":"openai"},
-    "DECP": {"provider":"openai"},
-    "DESPR": {"provider":"openai"},
+class AgentSpec(NamedTuple):
+    provider: str
+    model: str | None = None  # None = provider default (MODEL_DEFAULT)
+
+# every agent currently runs on OpenAI with the default model -> one shared spec object
+_OPENAI_DEFAULT = AgentSpec(provider="openai")
+
+AGENT_SPECS: dict[str, AgentSpec] = {
+    code: _OPENAI_DEFAULT
+    for code in (
+        "CFS", "CFP", "CFPR",
+        "REVS", "REVP", "REVPR",
+        "CAPEXS", "CAPEXP", "CAPEXPR",
+        "FXS", "FXP", "FXPR",
+        "COSTS", "COSTP", "COSTPR",
+        "BUDS", "BUDP", "BUDPR",
+        "REPS", "REPP", "REPPR",
+        "VARS", "VARP", "VARPR",
+        "MARS", "MARP", "MARPR",
+        "FORS", "FORP", "FORPR",
+        "DECS", "DECP", "DESPR",
+    )
 }
 
 class AgentRunner:
-    def __init__(self, openai_api_key: str):
+    def __init__(self, openai_api_key: str | None = None, http_client=None):
         self.providers = {
-            "openai": OpenAIProvider(openai_api_key),
+            "openai": OpenAIProvider(openai_api_key, http_client=http_client),
             "dummy":  DummyProvider(),
         }
+        # slug -> (provider, spec) resolved once; run() is a single lookup + unpack
+        self._dispatch = {
+            slug: (self.providers[spec.provider], spec)
+            for slug, spec in AGENT_SPECS.items()
+        }
 
     async def run(self, agent_slug: str, payload: dict) -> dict:
-        spec = AGENT_SPECS.get(agent_slug)
-        if not spec:
+        target = self._dispatch.get(agent_slug)
+        if not target:
             raise ValueError(f"Unknown agent_slug '{agent_slug}'")
-        provider = self.providers[spec["provider"]]
+        provider, spec = target
         return await provider.execute(spec, payload)
@@ -1,3 +1,3 @@
 class DummyProvider:
-    async def execute(self, spec: dict, payload: dict) -> dict:
-        return {"mock": True, "echo": payload, "agent_spec": spec}
+    async def execute(self, spec, payload: dict) -> dict:
+        return {"mock": True, "echo": payload, "agent_spec": spec._asdict()}
@@ -2,17 +2,21 @@ import os, httpx
 from app.config import MODEL_DEFAULT
 
 class OpenAIProvider:
-    def __init__(self, api_key: str | None = None):
+    def __init__(self, api_key: str | None = None, http_client: httpx.AsyncClient | None = None):
         self.api_key = api_key or os.getenv("OPENAI_API_KEY","")
+        self.http = http_client  # shared pooled client (keep-alive); None = one-off client per call
 
-    async def execute(self, spec: dict, payload: dict) -> dict:
+    async def execute(self, spec, payload: dict) -> dict:
         headers = {"Authorization": f"Bearer {self.api_key}","Content-Type":"application/json"}
-        model = spec.get("model", MODEL_DEFAULT)  # default to GPT-5 unless overridden per agent
+        model = spec.model or MODEL_DEFAULT  # default to GPT-5 unless overridden per agent
         body = {
             "model": model,
             "messages": payload.get("messages", [{"role":"user","content":"Hello from Gateway"}])
         }
-        async with httpx.AsyncClient(timeout=60) as client:
-            r = await client.post("https://api.openai.com/v1/chat/completions", json=body, headers=headers)
-            r.raise_for_status()
-            return r.json()
+        if self.http is not None:
+            r = await self.http.post("https://api.openai.com/v1/chat/completions", json=body, headers=headers, timeout=60)
+        else:
+            async with httpx.AsyncClient(timeout=60) as client:
+                r = await client.post("https://api.openai.com/v1/chat/completions", json=body, headers=headers)
+        r.raise_for_status()
+        return r.json()
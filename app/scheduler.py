@@ -65,39 +65,32 @@ def send_daily_emails():
         log.warning("ensure_permanent_admin_user skipped: %s", e)
 
     total_sent = total_failed = 0
-    for day in (1, 10, 23):
-        try:
-            users = db.get_trial_users_by_day(day_offset=day) or []
-        except Exception as e:
-            users = []
-            log.error("DB error fetching trial users for Day %s: %s", day, e)
-
+    days = (1, 10, 23)
+    links = {
+        "gpt_link": os.getenv("LINK_GPT", "https://chat.openai.com/"),
+        "gemini_link": os.getenv("LINK_GEMINI", "https://gemini.google.com/"),
+        "copilot_link": os.getenv("LINK_COPILOT", "https://copilot.microsoft.com/"),
+        "upgrade_link": os.getenv("LINK_UPGRADE", "https://example.com/upgrade"),
+    }
+
+    # ผู้ใช้ทุก Day จาก query เดียว โหลดเป็น list แล้วคืน connection ก่อนเริ่มส่ง
+    # (กลุ่ม trial เล็ก; ไม่ถือ connection/transaction ค้างไว้ตลอดช่วงส่ง SMTP หลายนาที)
+    users_by_day = db.get_trial_users_for_offsets(days)  # DB error → {} (log ใน db แล้ว)
+
+    for day in days:
+        users = users_by_day.get(day)
+        if users is None:
+            log.error("Skipping Day %s emails: trial users could not be loaded.", day)
+            continue
         if not users:
             log.info("No trial users for Day %s.", day)
             continue
-
-        sent = failed = 0
-        for user in users:
-            try:
-                ok = email_sender.send_trial_email(
-                    day,
-                    user,
-                    agent_name="Finance AI Agent",
-                    links={
-                        "gpt_link": os.getenv("LINK_GPT", "https://chat.openai.com/"),
-                        "gemini_link": os.getenv("LINK_GEMINI", "https://gemini.google.com/"),
-                        "copilot_link": os.getenv("LINK_COPILOT", "https://copilot.microsoft.com/"),
-                        "upgrade_link": os.getenv("LINK_UPGRADE", "https://example.com/upgrade"),
-                    },
-                )
-                if ok:
-                    sent += 1
-                else:
-                    failed += 1
-            except Exception as e:
-                failed += 1
-                log.error("Send error (Day %s) to %s: %s", day, user.get("user_email"), e)
-
+        try:
+            sent, failed = email_sender.send_trial_batch(day, users, agent_name="Finance AI Agent", links=links)
+        except Exception as e:
+            # error ฝั่งส่ง (SMTP/template) ไม่ใช่ DB — และไม่ทำให้ Day ถัดไปถูกข้าม
+            log.error("Send error for Day %s emails: %s", day, e)
+            continue
         log.info("Day %s emails: sent=%d failed=%d", day, sent, failed)
         total_sent += sent
         total_failed += failed
@@ -15,3 +15,10 @@ keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
 accesslog = "-"
 errorlog = "-"
 loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+# ถ้า app.db ถูก import ก่อน fork (เช่นเปิด preload_app) ให้แต่ละ worker สร้าง DB pool ของตัวเอง
+def post_fork(server, worker):
+    import sys
+    dbmod = sys.modules.get("app.db")
+    if dbmod is not None:
+        dbmod.reset_pool_after_fork()
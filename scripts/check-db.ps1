@@ -1,9 +1,10 @@
 # scripts/check-db.ps1 — quick Postgres sanity checks (non-interactive)
-# Uses embedded password as requested.
+# Reads the connection string from $env:DATABASE_URL (no password in source).
 $PSQL   = "C:\Program Files\PostgreSQL\17\bin\psql.exe"
 
 # === EDITABLE ===
-$DBPARMS = "host=dpg-d2e1kvbuibrs738im6s0-a.singapore-postgres.render.com port=5432 dbname=thanyaaura_entitlement user=thanyaaura_admin password='YdIb7eiPjpYS5VcYfEltdEA2hIrME3mC' sslmode=require"
+$DBPARMS = $env:DATABASE_URL
+if (-not $DBPARMS) { Write-Error "DATABASE_URL is not set"; exit 1 }
 $EMAIL   = "buyer@example.com"
 
 Write-Host "Checking database connection..." -ForegroundColor Cyan